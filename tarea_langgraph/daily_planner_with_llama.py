@@ -8,25 +8,156 @@ Validador usa Llama 3.2 para verificar descansos. Flujo: START → Analizar →
 Planificar → Validar → END. Requiere Ollama con Llama 3.2 instalado.
 """
 
+import argparse
+import contextvars
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+from bisect import bisect_right
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import TypedDict
-from langgraph.graph import StateGraph, START, END
-from langchain.llms import Ollama
 
-# Inicializar Llama 3.2 via Ollama
-llm = Ollama(model="llama3.2", temperature=0.7)
+# langchain y langgraph se importan al primer uso: importar este módulo no toca Ollama
+
+_llms = {}
+_llm_lock = threading.Lock()
+
+
+def get_llm(json_mode: bool = False):
+    """Cliente Llama 3.2 compartido, creado al primer uso.
+
+    json_mode=True usa el modo JSON de Ollama: la salida siempre es un objeto JSON parseable.
+    """
+    with _llm_lock:
+        if json_mode not in _llms:
+            from langchain.llms import Ollama
+            if json_mode:
+                _llms[json_mode] = Ollama(model="llama3.2", temperature=0, format="json")
+            else:
+                _llms[json_mode] = Ollama(model="llama3.2", temperature=0.7)
+        return _llms[json_mode]
+
+
+VALID_TYPES = {"clases", "ejercicio", "trabajo", "descanso", "comida", "estudio",
+               "personal", "cine", "lectura", "pasear"}
+
+# Sinónimos (sin tildes, en minúsculas) → tipo de actividad; misma tabla que el prompt del analizador
+ACTIVITY_SYNONYMS = {
+    "clases": ["clase", "clases", "curso", "cursos", "universidad", "colegio", "laboratorio"],
+    "ejercicio": ["gimnasio", "gym", "ejercicio", "entrenar", "entrenamiento", "correr", "futbol", "nadar"],
+    "trabajo": ["trabajo", "trabajar", "oficina", "reunion", "reuniones", "chamba"],
+    "descanso": ["pausa", "relax", "relajarme", "relajarse", "descansar", "descanso", "siesta", "dormir"],
+    "comida": ["comida", "comer", "almuerzo", "almorzar", "cena", "cenar", "desayuno", "desayunar"],
+    "estudio": ["estudiar", "estudio", "tarea", "tareas", "examen", "examenes", "repasar"],
+    "personal": ["personal", "compras", "tramites", "limpiar"],
+    "cine": ["cine", "pelicula", "peliculas"],
+    "lectura": ["leer", "lectura", "libro"],
+    "pasear": ["pasear", "paseo", "caminar", "caminata", "salida", "salir"],
+}
+KEYWORD_TYPES = {word: atype for atype, words in ACTIVITY_SYNONYMS.items() for word in words}
+SEGMENT_SPLIT = re.compile(r"[,;.]|\by\b|\be\b|\bluego\b|\bdespues\b")
+
+# Llamadas a Llama 3.2 hechas y evitadas por nodo (ej: "validar_llm", "validar_evitadas")
+llm_stats = Counter()
+_stats_lock = threading.Lock()
+
+# Máximo de llamadas simultáneas a Ollama (el resto de cada nodo sí corre en paralelo)
+OLLAMA_CONCURRENCY = int(os.getenv("OLLAMA_CONCURRENCY", "2"))
+_ollama_slots = threading.BoundedSemaphore(OLLAMA_CONCURRENCY)
+
+
+def count(key: str):
+    with _stats_lock:
+        llm_stats[key] += 1
+
+
+# Marca (por hilo) que un nodo usó un valor por defecto porque Ollama falló: ese resultado no se cachea
+_fallback = threading.local()
+
+
+# (nodo, callback) del nodo en curso cuando se ejecuta con eventos; None sin streaming
+_node_events = contextvars.ContextVar("node_events", default=None)
+
+
+def invoke_llm(prompt: str, json_mode: bool = False) -> str:
+    """Llama a Llama 3.2 respetando el límite de concurrencia hacia Ollama.
+    Si hay un receptor de eventos, emite los tokens a medida que llegan."""
+    current = _node_events.get()
+    with _ollama_slots:
+        llm = get_llm(json_mode)
+        if current is None:
+            return llm.invoke(prompt)
+        node, on_event = current
+        parts = []
+        for chunk in llm.stream(prompt):
+            parts.append(chunk)
+            on_event({"event": "token", "node": node, "text": chunk})
+        return "".join(parts)
 
 
 class DayPlanState(TypedDict):
     user_input: str
+    days: int
     extracted_activities: list
     daily_plan: str
     is_valid: bool
     validation_msg: str
 
 
+def fold(text: str) -> str:
+    """Minúsculas y sin tildes"""
+    return "".join(c for c in unicodedata.normalize("NFD", text.lower()) if unicodedata.category(c) != "Mn")
+
+
+def keyword_activities(user_input: str):
+    """Extrae tipos por sinónimos. Devuelve ({tipo: veces} en orden de aparición, fragmentos sin reconocer).
+
+    Cada fragmento ("gimnasio en la mañana", "gimnasio en la tarde") cuenta una vez por tipo,
+    hasta MAX_COUNT por tipo como en la ruta del modelo.
+    """
+    types, unknown = Counter(), []
+    for segment in SEGMENT_SPLIT.split(fold(user_input)):
+        words = re.findall(r"\w+", segment)
+        if not words:
+            continue
+        found = list(dict.fromkeys(KEYWORD_TYPES[w] for w in words if w in KEYWORD_TYPES))
+        if not found:
+            unknown.append(segment.strip())
+        types.update(found)
+    return {t: min(n, MAX_COUNT) for t, n in types.items()}, unknown
+
+
+def parse_llm_activities(response: str) -> dict:
+    """{tipo: veces} de la respuesta JSON del modelo (los tipos desconocidos se descartan)"""
+    data = json.loads(response)
+    types = {}
+    for a in data.get("activities", []):
+        if isinstance(a, dict) and a.get("type") in VALID_TYPES:
+            n = a.get("count", 1)
+            types[a["type"]] = min(max(n if isinstance(n, int) else 1, 1), MAX_COUNT)
+    return types
+
+
+def make_activity(atype: str, n: int = 1) -> dict:
+    """Actividad con la duración típica de su tipo"""
+    return {"type": atype, "duration": ACTIVITY_PROFILES[atype][1], "count": n}
+
+
 def analyze_activities(state: DayPlanState) -> DayPlanState:
-    """Nodo 1: Llama 3.2 analiza entrada y extrae actividades"""
+    """Nodo 1: extrae actividades por sinónimos; Llama 3.2 (modo JSON) solo si queda texto sin reconocer"""
     user_input = state["user_input"]
+    types, unknown = keyword_activities(user_input)
+    if types and not unknown:
+        count("analizar_evitadas")
+        activities = [make_activity(t, n) for t, n in types.items()]
+        return {**state, "extracted_activities": activities, "is_valid": False, "validation_msg": ""}
 
     # Prompt para Llama 3.2
     prompt = f"""Analiza esta descripción de día y extrae actividades.
@@ -52,55 +183,280 @@ MAPEO IMPORTANTE:
 
 Responde SOLO el JSON:"""
 
+    count("analizar_llm")
     try:
-        response = llm.invoke(prompt)
-        import json
-        data = json.loads(response)
-        activities = [{"type": a["type"], "duration": 60}
-                     for a in data.get("activities", [])]
-    except:
-        activities = [{"type": "general", "duration": 120}]
+        llm_types = parse_llm_activities(invoke_llm(prompt, json_mode=True))
+    except Exception:
+        llm_types = {}
+        _fallback.used = True
+    # Lo reconocido por sinónimos se conserva aunque el modelo falle
+    merged = dict(types)
+    for t, n in llm_types.items():
+        merged[t] = max(merged.get(t, 0), n)
+    activities = [make_activity(t, n) for t, n in merged.items()]
 
     if not activities:
-        activities = [{"type": "general", "duration": 120}]
+        activities = [make_activity("general")]
 
     return {**state, "extracted_activities": activities, "is_valid": False, "validation_msg": ""}
 
 
+# --- Motor de agenda por intervalos -----------------------------------------
+
+GRANULARITY = 5          # minutos
+DAY_START, DAY_END = 7 * 60, 22 * 60
+MIN_CHUNK = 30           # una actividad partida no deja trozos menores
+PAUSE_AFTER = 15         # pausa tras actividades intensivas
+MAX_COUNT = 4
+PLAN_DAYS = max(int(os.getenv("PLAN_DAYS", "1")), 1)   # días por plan si no se indica otro
+INTENSIVE = {"clases", "ejercicio", "trabajo"}
+
+# Comidas fijas de cada día: (inicio, fin, etiqueta)
+FIXED_BLOCKS = [("07:00", "08:00", "Desayuno"), ("12:00", "13:30", "Almuerzo"), ("19:00", "20:00", "Cena")]
+
+# tipo → (etiqueta, duración típica en min, prioridad, franja preferida)
+ACTIVITY_PROFILES = {
+    "clases": ("Clases", 240, 3, ("08:00", "12:00")),
+    "trabajo": ("Trabajo", 240, 3, ("08:00", "17:00")),
+    "estudio": ("Estudio", 120, 2, ("13:30", "17:00")),
+    "ejercicio": ("Ejercicio", 90, 2, ("16:00", "19:00")),
+    "personal": ("Personal", 90, 1, ("17:30", "19:00")),
+    "pasear": ("Pasear con familia", 90, 1, ("17:30", "19:00")),
+    "cine": ("Cine", 120, 1, ("17:30", "22:00")),
+    "lectura": ("Lectura", 60, 1, ("20:00", "22:00")),
+    "descanso": ("Relax", 60, 1, ("20:00", "22:00")),
+    "comida": ("Comida", 60, 1, ("12:00", "13:30")),
+    "general": ("Actividades generales", 120, 1, ("08:00", "22:00")),
+}
+
+
+def to_minutes(hhmm: str) -> int:
+    h, m = hhmm.split(":")
+    return int(h) * 60 + int(m)
+
+
+def to_hhmm(minutes: int) -> str:
+    minutes %= 24 * 60
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def snap_up(minute: int) -> int:
+    return -(-minute // GRANULARITY) * GRANULARITY
+
+
+class Timeline:
+    """Bloques ordenados y sin solapamiento que cubren [start, end) en minutos absolutos
+    (día d = d * 1440 + minuto). Los huecos libres son bloques con etiqueta None.
+
+    insert() parte los bloques en los bordes (split) y ocupa el rango; remove() lo libera
+    y fusiona los huecos vecinos (merge). Las búsquedas usan bisect sobre los inicios, así
+    que el costo depende de la cantidad de bloques y no de la granularidad.
+    """
+
+    def __init__(self, start: int, end: int):
+        self.starts = [start]
+        self.blocks = [[start, end, None, None]]   # [inicio, fin, etiqueta, tipo]
+
+    def _index(self, minute: int) -> int:
+        return bisect_right(self.starts, minute) - 1
+
+    def split(self, minute: int) -> int:
+        """Asegura que un bloque empiece en `minute`; devuelve su índice"""
+        i = self._index(minute)
+        block = self.blocks[i]
+        if block[0] == minute:
+            return i
+        self.blocks.insert(i + 1, [minute, block[1], block[2], block[3]])
+        self.starts.insert(i + 1, minute)
+        block[1] = minute
+        return i + 1
+
+    def is_free(self, start: int, end: int) -> bool:
+        i = self._index(start)
+        while i < len(self.blocks) and self.blocks[i][0] < end:
+            if self.blocks[i][2] is not None:
+                return False
+            i += 1
+        return True
+
+    def insert(self, start: int, end: int, label: str, atype: str = None):
+        if not self.is_free(start, end):
+            raise ValueError(f"{label}: {to_hhmm(start)}-{to_hhmm(end)} se solapa con otro bloque")
+        i = self.split(start)
+        j = self.split(end) if end < self.blocks[-1][1] else len(self.blocks)
+        del self.blocks[i + 1:j], self.starts[i + 1:j]
+        self.blocks[i][1:] = [end, label, atype]
+
+    def remove(self, start: int):
+        """Libera el bloque que empieza en `start`"""
+        i = self._index(start)
+        self.blocks[i][2:] = [None, None]
+        self.merge(i)
+
+    def merge(self, i: int):
+        """Fusiona el hueco i con los huecos adyacentes"""
+        while i > 0 and self.blocks[i - 1][2] is None and self.blocks[i][2] is None:
+            i -= 1
+        while i + 1 < len(self.blocks) and self.blocks[i][2] is None and self.blocks[i + 1][2] is None:
+            self.blocks[i][1] = self.blocks[i + 1][1]
+            del self.blocks[i + 1], self.starts[i + 1]
+
+    def gaps(self, lo: int, hi: int):
+        """Huecos libres recortados a [lo, hi), con inicio alineado a la granularidad"""
+        i = max(self._index(lo), 0)
+        while i < len(self.blocks) and self.blocks[i][0] < hi:
+            start, end, label, _ = self.blocks[i]
+            if label is None:
+                start, end = snap_up(max(start, lo)), min(end, hi)
+                if end > start:
+                    yield start, end
+            i += 1
+
+    def find(self, duration: int, lo: int, hi: int, target: int = None):
+        """Inicio con `duration` minutos libres dentro de [lo, hi) lo más cerca posible
+        de `target` (por defecto el primero desde `lo`), o None"""
+        target = lo if target is None else target
+        best = None
+        for start, end in self.gaps(lo, hi):
+            candidate = snap_up(min(max(target, start), end - duration))
+            if candidate < start or candidate + duration > end:
+                continue
+            if best is None or abs(candidate - target) < abs(best - target):
+                best = candidate
+            if start >= target:
+                break   # los huecos siguientes solo quedan más lejos
+        return best
+
+
+def place_activity(timeline: Timeline, day: int, atype: str, duration: int, placed: list = None) -> int:
+    """Ubica una instancia: franja preferida, luego cualquier hueco del día y, si no cabe
+    entera, en trozos de al menos MIN_CHUNK. Devuelve los minutos que no cupieron; los
+    inicios de los bloques agregados (pausas incluidas) se anotan en `placed`."""
+    label, _, _, (pref_lo, pref_hi) = ACTIVITY_PROFILES[atype]
+    base = day * 24 * 60
+    day_lo, day_hi = base + DAY_START, base + DAY_END
+    windows = [(base + to_minutes(pref_lo), base + to_minutes(pref_hi)), (day_lo, day_hi)]
+    for lo, hi in windows:
+        start = timeline.find(duration, lo, hi, target=windows[0][0])
+        if start is not None:
+            add_block(timeline, start, start + duration, label, atype, placed)
+            return 0
+
+    left = duration
+    for lo, hi in windows:
+        for start, end in list(timeline.gaps(lo, hi)):
+            chunk = min(end - start, left)
+            rest = left - chunk
+            if 0 < rest < MIN_CHUNK:
+                chunk -= MIN_CHUNK - rest   # deja un resto de al menos MIN_CHUNK
+            if chunk < MIN_CHUNK or not timeline.is_free(start, start + chunk):
+                continue
+            add_block(timeline, start, start + chunk, label, atype, placed)
+            left -= chunk
+            if not left:
+                return 0
+    return left
+
+
+def add_block(timeline: Timeline, start: int, end: int, label: str, atype: str, placed: list = None):
+    timeline.insert(start, end, label, atype)
+    added = [start]
+    if atype in INTENSIVE and end - start >= 60 and timeline.is_free(end, end + PAUSE_AFTER):
+        timeline.insert(end, end + PAUSE_AFTER, "Pausa", "descanso")
+        added.append(end)
+    if placed is not None:
+        placed.extend(added)
+
+
+def place_or_evict(timeline: Timeline, day: int, atype: str, duration: int) -> list:
+    """place_activity; si no cabe entera, desaloja los bloques de menor prioridad del día
+    (las comidas fijas nunca), ubica esta instancia y vuelve a ubicar los desalojados.
+    Las pausas desalojadas no se reubican: ceden su lugar. Devuelve [(etiqueta, minutos sin ubicar)]."""
+    label, _, priority, _ = ACTIVITY_PROFILES[atype]
+    placed = []
+    left = place_activity(timeline, day, atype, duration, placed)
+    if not left:
+        return []
+    base = day * 24 * 60
+    victims = [list(b) for b in timeline.blocks
+               if b[2] is not None and b[3] != "comida" and base + DAY_START <= b[0] < base + DAY_END
+               and ACTIVITY_PROFILES[b[3]][2] < priority and b[0] not in placed]
+    if not victims:
+        return [(label, left)]
+    for start in placed + [b[0] for b in victims]:
+        timeline.remove(start)
+    unplaced = []
+    left = place_activity(timeline, day, atype, duration)
+    if left:
+        unplaced.append((label, left))
+    for start, end, vlabel, vtype in victims:
+        if vlabel == "Pausa":
+            continue
+        rest = place_activity(timeline, day, vtype, end - start)
+        if rest:
+            unplaced.append((vlabel, rest))
+    return unplaced
+
+
+def window_length(atype: str) -> int:
+    lo, hi = ACTIVITY_PROFILES[atype][3]
+    return to_minutes(hi) - to_minutes(lo)
+
+
+def build_schedule(activities: list, days: int = 1):
+    """Arma la agenda de `days` días. Las instancias (count) se reparten entre días y se
+    ubican por prioridad y duración; si una no cabe desplaza a las de menor prioridad
+    (place_or_evict). Devuelve (timeline, [(etiqueta, minutos sin ubicar)])."""
+    timeline = Timeline(DAY_START, (days - 1) * 24 * 60 + DAY_END)
+    for day in range(days):
+        base = day * 24 * 60
+        for start, end, label in FIXED_BLOCKS:
+            timeline.insert(base + to_minutes(start), base + to_minutes(end), label, "comida")
+
+    instances = []
+    for a in activities:
+        if a["type"] == "comida":
+            continue   # ya cubierta por las comidas fijas
+        for k in range(a.get("count", 1)):
+            instances.append((a["type"], a["duration"], k))
+    # Primero lo prioritario; a igual prioridad, la franja más estrecha y luego lo más largo
+    instances.sort(key=lambda x: (-ACTIVITY_PROFILES[x[0]][2], window_length(x[0]), -x[1]))
+
+    conflicts = []
+    for atype, duration, k in instances:
+        conflicts.extend(place_or_evict(timeline, k % days, atype, duration))
+    return timeline, conflicts
+
+
+def format_timeline(timeline: Timeline, acts: set, days: int = 1) -> str:
+    lines = []
+    for day in range(days):
+        base = day * 24 * 60
+        if days > 1:
+            lines.append(f"Día {day + 1}:")
+        for start, end, label, atype in timeline.blocks:
+            if start >= base + DAY_END or end <= base + DAY_START:
+                continue
+            # El hueco nocturno cruza días: se muestra solo la parte dentro del día
+            start, end = max(start, base + DAY_START), min(end, base + DAY_END)
+            marker = "✓" if atype in acts else " "
+            span = f"{to_hhmm(start)}-{to_hhmm(end)}"
+            lines.append(f"{marker} {span:<12} → {label or 'Libre'}")
+        lines.append(f"  {'22:00+':<12} → Dormir")
+    return "\n".join(lines) + "\n"
+
+
 def plan_daily_schedule(state: DayPlanState) -> DayPlanState:
-    """Nodo 2: Planificador genera horario"""
+    """Nodo 2: Planificador ubica las actividades en la agenda por intervalos"""
     acts = {a["type"] for a in state["extracted_activities"]}
-    plan = "📅 PLAN DIARIO PERSONALIZADO\n" + "=" * 50 + "\n\nHORARIO:\n" + "-" * 50 + "\n"
-
-    schedule = [
-        ("07:00-08:00", "Desayuno", "personal"), ("08:00-12:00", "Clases/Trabajo", "clases"),
-        ("12:00-13:30", "Almuerzo", "comida"), ("13:30-15:30", "Estudio", "estudio"),
-        ("15:30-16:00", "Pausa", "descanso"), ("16:00-17:30", "Ejercicio", "ejercicio"),
-        ("17:30-19:00", "Personal", "personal"), ("19:00-20:00", "Cena", "comida"),
-        ("20:00-22:00", "Relax", "descanso"), ("22:00+", "Dormir", "descanso"),
-    ]
-
-    # Mapeo de actividades del usuario a franjas horarias
-    activity_mapping = {
-        "clases": ("08:00-12:00", "Clases"),
-        "trabajo": ("08:00-12:00", "Trabajo"),
-        "ejercicio": ("16:00-17:30", "Ejercicio"),
-        "estudio": ("13:30-15:30", "Estudio"),
-        "cine": ("17:30-19:00", "Cine"),
-        "lectura": ("20:00-22:00", "Lectura"),
-        "personal": ("17:30-19:00", "Personal"),
-        "pasear": ("17:30-19:00", "Pasear con familia"),
-    }
+    days = max(state.get("days") or 1, 1)
+    title = "PLAN DIARIO PERSONALIZADO" if days == 1 else f"PLAN PERSONALIZADO ({days} DÍAS)"
+    plan = f"📅 {title}\n" + "=" * 50 + "\n\nHORARIO:\n" + "-" * 50 + "\n"
 
-    for time, act, atype in schedule:
-        marker = "✓" if atype in acts else " "
-        # Si la actividad del usuario coincide con esta franja, mostrar la actividad del usuario
-        display_act = act
-        for user_activity_type, (activity_time, activity_name) in activity_mapping.items():
-            if user_activity_type in acts and activity_time == time:
-                display_act = activity_name
-                break
-        plan += f"{marker} {time:<12} → {display_act}\n"
+    timeline, conflicts = build_schedule(state["extracted_activities"], days)
+    plan += format_timeline(timeline, acts, days)
+    for label, minutes in conflicts:
+        plan += f"⚠️  Sin espacio: {label} ({minutes} min)\n"
 
     plan += "\n" + "=" * 50 + "\n💡 RECOMENDACIONES:\n" + "-" * 50 + "\n"
     rec = {"clases": "Descarga diapositivas", "ejercicio": "Mantente hidratado",
@@ -119,17 +475,8 @@ def plan_daily_schedule(state: DayPlanState) -> DayPlanState:
     return {**state, "daily_plan": plan, "is_valid": False, "validation_msg": ""}
 
 
-def validate_rest_periods(state: DayPlanState) -> DayPlanState:
-    """Nodo 3: Llama 3.2 valida descansos de forma inteligente"""
-    acts = {a["type"] for a in state["extracted_activities"]}
-
-    # Actividades intensivas que requieren descanso obligatorio
-    intensive = {"clases", "ejercicio", "trabajo"}
-    relaxed = {"cine", "lectura", "personal", "descanso", "estudio", "pasear"}
-    has_intensive = any(a in acts for a in intensive)
-    has_break = any(a in acts for a in {"descanso", "comida"})
-    has_only_relaxed = all(a in relaxed for a in acts)
-
+def validate_with_llm(state: DayPlanState) -> dict:
+    """Caso no resuelto por las reglas: Llama 3.2 decide APROBADO/RECHAZADO/ADVERTENCIA"""
     activities_str = str([a["type"] for a in state["extracted_activities"]])
     plan_summary = state["daily_plan"][:300]
 
@@ -150,16 +497,43 @@ Responde SOLO una palabra: APROBADO, RECHAZADO o ADVERTENCIA
 
 Respuesta:"""
 
+    count("validar_llm")
     try:
-        response = llm.invoke(prompt).strip().upper()
+        response = invoke_llm(prompt).strip().upper()
     except:
         response = "APROBADO"
+        _fallback.used = True
+
+    if "RECHAZADO" in response:
+        msg = "❌ PLAN RECHAZADO:\nPlan muy exigente sin descansos suficientes\n\n"
+        msg += "SOLUCIONES:\n• Reduce actividades intensivas\n• Agrega pausas entre actividades"
+        is_valid = False
+    elif "ADVERTENCIA" in response:
+        msg = "⚠️  ADVERTENCIA: Plan con actividades intensivas sin pausas óptimas\n"
+        msg += "RECOMENDACIÓN: Considera agregar descansos de 15-30 min"
+        is_valid = False
+    else:
+        msg = "✅ PLAN APROBADO - Plan equilibrado y saludable (validado por Llama 3.2)"
+        is_valid = True
+    return {"is_valid": is_valid, "validation_msg": msg}
+
+
+def validate_rest_periods(state: DayPlanState) -> DayPlanState:
+    """Nodo 3: valida descansos con reglas; Llama 3.2 solo para casos no resueltos"""
+    acts = {a["type"] for a in state["extracted_activities"]}
+
+    # Actividades intensivas que requieren descanso obligatorio
+    intensive = {"clases", "ejercicio", "trabajo"}
+    relaxed = {"cine", "lectura", "personal", "descanso", "estudio", "pasear"}
+    has_intensive = any(a in acts for a in intensive)
+    has_break = any(a in acts for a in {"descanso", "comida"})
+    has_only_relaxed = all(a in relaxed for a in acts)
 
     # Verificar si el horario incluye descansos (Pausa, Relax, Cena)
     plan_lower = state["daily_plan"].lower()
     has_scheduled_breaks = any(break_word in plan_lower for break_word in ["pausa", "relax", "cena", "almuerzo", "desayuno"])
 
-    # Lógica mejorada: considera el contexto
+    # Reglas deterministas primero: Llama 3.2 solo se consulta si ninguna decide
     if has_only_relaxed:
         # Si solo hay actividades relajadas, aprueba automáticamente
         msg = "✅ PLAN APROBADO - Día relajado y equilibrado"
@@ -168,32 +542,164 @@ Respuesta:"""
         # Si hay actividades intensivas PERO hay descansos (explícitos o en el horario), aprueba
         msg = "✅ PLAN APROBADO - Plan equilibrado con descansos adecuados"
         is_valid = True
-    elif has_intensive and not has_break and not has_scheduled_breaks:
+    elif has_intensive:
         # Rechaza SOLO si hay actividades intensivas sin descanso ni en plan
         msg = "❌ PLAN RECHAZADO:\nTienes actividades intensivas (clases/ejercicio/trabajo) sin descanso\n\n"
         msg += "SOLUCIONES:\n• Agrega pausas de 30+ min\n• Incluye tiempo para comer\n• Asegura 7-8 hrs sueño"
         is_valid = False
-    elif "RECHAZADO" in response:
-        msg = "❌ PLAN RECHAZADO:\nPlan muy exigente sin descansos suficientes\n\n"
-        msg += "SOLUCIONES:\n• Reduce actividades intensivas\n• Agrega pausas entre actividades"
-        is_valid = False
-    elif "ADVERTENCIA" in response:
-        msg = "⚠️  ADVERTENCIA: Plan con actividades intensivas sin pausas óptimas\n"
-        msg += "RECOMENDACIÓN: Considera agregar descansos de 15-30 min"
-        is_valid = False
     else:
-        msg = "✅ PLAN APROBADO - Plan equilibrado y saludable (validado por Llama 3.2)"
-        is_valid = True
+        return {**state, **validate_with_llm(state)}
 
+    count("validar_evitadas")
     return {**state, "is_valid": is_valid, "validation_msg": msg}
 
 
+# --- Caché de nodos (persistente) ------------------------------------------
+
+NODE_CACHE_DB = os.getenv("NODE_CACHE_DB", os.path.join(os.path.dirname(os.path.abspath(__file__)), "node_cache.db"))
+NODE_CACHE_MAX = int(os.getenv("NODE_CACHE_MAX", "5000"))
+# Subir al cambiar la lógica de un nodo: invalida los resultados guardados
+NODE_CACHE_VERSION = 3
+# Tablas y constantes que usan los nodos: editarlas también invalida la caché
+NODE_CACHE_CONFIG = hashlib.sha256(json.dumps(
+    [ACTIVITY_SYNONYMS, sorted(VALID_TYPES), ACTIVITY_PROFILES, FIXED_BLOCKS, sorted(INTENSIVE),
+     GRANULARITY, DAY_START, DAY_END, MIN_CHUNK, PAUSE_AFTER, MAX_COUNT],
+    ensure_ascii=False, sort_keys=True,
+).encode("utf-8")).hexdigest()[:16]
+
+# Entrada relevante y campos que produce cada nodo
+NODE_INPUTS = {
+    "analizar": lambda s: s["user_input"].strip(),
+    "planificar": lambda s: [s["extracted_activities"], s.get("days") or 1],
+    "validar": lambda s: [s["extracted_activities"], s["daily_plan"]],
+}
+NODE_OUTPUTS = {
+    "analizar": ("extracted_activities",),
+    "planificar": ("daily_plan",),
+    "validar": ("is_valid", "validation_msg"),
+}
+
+
+class NodeCache:
+    """Resultados por nodo en SQLite, con clave = hash de la entrada relevante del nodo.
+
+    Cada nodo guarda su salida apenas termina, así que también hace de checkpoint:
+    si una ejecución falla en "validar", repetirla con la misma descripción reutiliza
+    "analizar" y "planificar" sin volver a llamar a Llama 3.2. Se desalojan las
+    entradas menos usadas recientemente al pasar de `max_entries`.
+    """
+
+    def __init__(self, path: str = NODE_CACHE_DB, max_entries: int = NODE_CACHE_MAX):
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS nodos (
+                clave TEXT PRIMARY KEY,
+                nodo TEXT NOT NULL,
+                valor TEXT NOT NULL,
+                usado REAL NOT NULL
+            )""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_nodos_usado ON nodos(usado)")
+
+    @staticmethod
+    def key(node: str, state: DayPlanState) -> str:
+        payload = json.dumps([NODE_CACHE_VERSION, NODE_CACHE_CONFIG, node, NODE_INPUTS[node](state)], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT valor FROM nodos WHERE clave = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE nodos SET usado = ? WHERE clave = ?", (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key: str, node: str, value: dict):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO nodos VALUES (?, ?, ?, ?)",
+                              (key, node, json.dumps(value, ensure_ascii=False), time.time()))
+            excess = self.conn.execute("SELECT COUNT(*) FROM nodos").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.conn.execute("DELETE FROM nodos WHERE clave IN "
+                                  "(SELECT clave FROM nodos ORDER BY usado LIMIT ?)", (excess,))
+
+
+_node_cache = None
+
+
+def get_node_cache():
+    """Caché compartida; NODE_CACHE=0 la desactiva"""
+    global _node_cache
+    if os.getenv("NODE_CACHE", "1") == "0":
+        return None
+    with _graph_lock:
+        if _node_cache is None:
+            _node_cache = NodeCache()
+        return _node_cache
+
+
+def cached_node(name: str, func):
+    """Envuelve un nodo: si su entrada ya se procesó, devuelve la salida guardada"""
+    def node(state: DayPlanState) -> DayPlanState:
+        cache = get_node_cache()
+        if cache is None:
+            return func(state)
+        key = NodeCache.key(name, state)
+        hit = cache.get(key)
+        if hit is not None:
+            count(f"{name}_cache")
+            return {**state, **hit}
+        _fallback.used = False
+        result = func(state)
+        if not _fallback.used:
+            cache.put(key, name, {field: result[field] for field in NODE_OUTPUTS[name]})
+        return result
+    return node
+
+
+def timed_node(name: str, func):
+    """Emite eventos start/end (duración y campos producidos) si la ejecución trae
+    config["configurable"]["on_event"]; sin receptor solo llama al nodo."""
+    def node(state: DayPlanState, config=None) -> DayPlanState:
+        on_event = ((config or {}).get("configurable") or {}).get("on_event")
+        if on_event is None:
+            return func(state)
+        on_event({"event": "start", "node": name})
+        token = _node_events.set((name, on_event))
+        t0 = time.perf_counter()
+        try:
+            result = func(state)
+        finally:
+            _node_events.reset(token)
+        on_event({"event": "end", "node": name, "ms": round((time.perf_counter() - t0) * 1000, 1),
+                  "state": {field: result[field] for field in NODE_OUTPUTS[name]}})
+        return result
+    return node
+
+
+_graph = None
+_graph_lock = threading.Lock()
+
+
 def build_graph():
-    """Construye el grafo de 3 nodos con Llama 3.2"""
+    """Construye el grafo de 3 nodos con Llama 3.2 (se compila una vez y se reutiliza)"""
+    global _graph
+    with _graph_lock:
+        if _graph is None:
+            _graph = compile_graph()
+        return _graph
+
+
+def compile_graph():
+    from langgraph.graph import StateGraph, START, END
+
     graph = StateGraph(DayPlanState)
-    graph.add_node("analizar", analyze_activities)
-    graph.add_node("planificar", plan_daily_schedule)
-    graph.add_node("validar", validate_rest_periods)
+    graph.add_node("analizar", timed_node("analizar", cached_node("analizar", analyze_activities)))
+    graph.add_node("planificar", timed_node("planificar", cached_node("planificar", plan_daily_schedule)))
+    graph.add_node("validar", timed_node("validar", cached_node("validar", validate_rest_periods)))
 
     graph.add_edge(START, "analizar")
     graph.add_edge("analizar", "planificar")
@@ -203,8 +709,128 @@ def build_graph():
     return graph.compile()
 
 
+def initial_state(user_input: str, days: int = None) -> DayPlanState:
+    return DayPlanState(user_input=user_input, days=days or PLAN_DAYS, extracted_activities=[],
+                        daily_plan="", is_valid=False, validation_msg="")
+
+
+def to_json_result(result: DayPlanState) -> dict:
+    return {
+        "user_input": result["user_input"],
+        "extracted_activities": result["extracted_activities"],
+        "is_valid": result["is_valid"],
+        "validation_message": result["validation_msg"]
+    }
+
+
+def run_streaming(user_input: str, on_event, days: int = None) -> DayPlanState:
+    """Ejecuta el grafo nodo a nodo enviando eventos a `on_event`:
+    {"event": "start"|"token"|"end", "node": ..., "ms"/"text"/"state": ...}"""
+    state = initial_state(user_input, days)
+    config = {"configurable": {"on_event": on_event}}
+    for update in build_graph().stream(state, config=config):
+        for value in update.values():
+            if isinstance(value, dict):
+                state = {**state, **value}
+    return state
+
+
+def console_progress():
+    """Receptor de eventos para la terminal: avance por nodo, tokens y latencias"""
+    streaming = {"tokens": False}
+
+    def on_event(event):
+        if event["event"] == "start":
+            print(f"▶ {event['node']}...", flush=True)
+        elif event["event"] == "token":
+            streaming["tokens"] = True
+            print(event["text"], end="", flush=True)
+        else:
+            if streaming["tokens"]:
+                print()
+                streaming["tokens"] = False
+            detail = ""
+            if event["node"] == "analizar":
+                detail = " → " + ", ".join(a["type"] for a in event["state"]["extracted_activities"])
+            print(f"✓ {event['node']} ({event['ms']} ms){detail}", flush=True)
+    return on_event
+
+
+def load_descriptions(path: str) -> list:
+    """Una descripción por línea; en .jsonl cada línea es un string o un objeto con "user_input"."""
+    descriptions = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if path.endswith(".jsonl"):
+                item = json.loads(line)
+                line = item if isinstance(item, str) else item["user_input"]
+            descriptions.append(line)
+    return descriptions
+
+
+def run_batch(descriptions: list, out, workers: int = 4, days: int = None) -> dict:
+    """Procesa las descripciones con el grafo compilado y escribe cada resultado en JSONL
+    apenas termina (campo "index" = posición en la entrada). Devuelve métricas de throughput."""
+    graph = build_graph()
+    calls_before = llm_stats["analizar_llm"] + llm_stats["validar_llm"]
+    errors = 0
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(graph.invoke, initial_state(d, days)): i for i, d in enumerate(descriptions)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                record = {"index": i, **to_json_result(future.result())}
+            except Exception as e:
+                errors += 1
+                record = {"index": i, "user_input": descriptions[i], "error": str(e)}
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+    elapsed = time.perf_counter() - t0
+    return {
+        "items": len(descriptions),
+        "errors": errors,
+        "seconds": round(elapsed, 2),
+        "items_per_second": round(len(descriptions) / elapsed, 2) if elapsed else 0.0,
+        "llm_calls": llm_stats["analizar_llm"] + llm_stats["validar_llm"] - calls_before,
+    }
+
+
+def main_cli(argv: list):
+    parser = argparse.ArgumentParser(description="Planificador LangGraph por lotes o con eventos")
+    mode = parser.add_mutually_exclusive_group(required=True)
+    mode.add_argument("--batch", help="archivo .txt (una descripción por línea) o .jsonl")
+    mode.add_argument("--events", metavar="DESCRIPCION", help="una descripción; imprime los eventos por nodo en JSONL")
+    parser.add_argument("--out", default="-", help="JSONL de salida (- = stdout)")
+    parser.add_argument("--workers", type=int, default=4, help="descripciones en paralelo")
+    parser.add_argument("--days", type=int, default=PLAN_DAYS, help="días a planificar")
+    args = parser.parse_args(argv)
+
+    if args.events:
+        emit = lambda event: print(json.dumps(event, ensure_ascii=False), flush=True)
+        emit({"event": "result", **to_json_result(run_streaming(args.events, emit, args.days))})
+        return
+
+    descriptions = load_descriptions(args.batch)
+    out = sys.stdout if args.out == "-" else open(args.out, "w", encoding="utf-8")
+    try:
+        report = run_batch(descriptions, out, args.workers, args.days)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"\n📈 {report['items']} descripciones ({report['errors']} errores) en {report['seconds']} s "
+          f"→ {report['items_per_second']} por segundo | llamadas a Llama 3.2: {report['llm_calls']} "
+          f"(máx. {OLLAMA_CONCURRENCY} simultáneas)", file=sys.stderr)
+
+
 def main():
     """Ejecuta el asistente con Llama 3.2"""
+    if len(sys.argv) > 1:
+        return main_cli(sys.argv[1:])
+
     print("\n" + "=" * 60)
     print("🗓️  ASISTENTE DE PLANIFICACIÓN CON LLAMA 3.2 + VALIDADOR")
     print("=" * 60 + "\n")
@@ -214,21 +840,19 @@ def main():
         user_input = "Tengo clases de IA, gimnasio y debo estudiar"
         print(f"(Usando: {user_input})\n")
 
-    state = DayPlanState(user_input=user_input, extracted_activities=[],
-                         daily_plan="", is_valid=False, validation_msg="")
-
     print("Procesando con Llama 3.2...\n")
-    result = build_graph().invoke(state)
+    result = run_streaming(user_input, console_progress())
 
     # PASO 1: Mostrar actividades detectadas
     print("\n" + "=" * 60)
     print("📋 ACTIVIDADES DETECTADAS (por Llama 3.2)")
     print("=" * 60)
     for a in result["extracted_activities"]:
-        print(f"  ✓ {a['type'].upper():<12} → {a['duration']} minutos")
+        times = f" x{a['count']}" if a.get("count", 1) > 1 else ""
+        print(f"  ✓ {a['type'].upper():<12} → {a['duration']} minutos{times}")
 
     activity_count = len(result["extracted_activities"])
-    total_time = sum(a["duration"] for a in result["extracted_activities"])
+    total_time = sum(a["duration"] * a.get("count", 1) for a in result["extracted_activities"])
     print(f"\nTotal: {activity_count} actividades | {total_time} minutos")
     print("=" * 60)
 
@@ -246,15 +870,11 @@ def main():
     # PASO 4: Mostrar JSON final
     print("\n📊 RESULTADO EN JSON:")
     print("=" * 60)
-    import json
-    json_result = {
-        "user_input": result["user_input"],
-        "extracted_activities": result["extracted_activities"],
-        "is_valid": result["is_valid"],
-        "validation_message": result["validation_msg"]
-    }
+    json_result = to_json_result(result)
     print(json.dumps(json_result, indent=2, ensure_ascii=False))
     print("=" * 60)
+    print(f"Llamadas a Llama 3.2 evitadas: análisis={llm_stats['analizar_evitadas']} "
+          f"validación={llm_stats['validar_evitadas']}")
 
 
 if __name__ == "__main__":
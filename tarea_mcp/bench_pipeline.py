@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Benchmark del pipeline de gastos: fetch → extract → export → summary
+
+Levanta un Ollama falso (/api/generate) con latencia y tasa de error
+configurables, genera alertas bancarias sintéticas y recorre el pipeline
+con MCPClient. Reporta correos/s, latencias p50/p99 por comando, llamadas
+al LLM y pico de memoria.
+
+Uso: python3 bench_pipeline.py --emails 10000 --latency-ms 5 --error-rate 0.01
+"""
+import argparse
+import json
+import mailbox
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from email.message import EmailMessage
+from email.utils import format_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BANCOS = [
+    ("alertas@bcp.com.pe", "BCP: Compra aprobada S/ {monto:.2f} en {comercio} {fecha}", "PEN"),
+    ("alertas@visa.com", "VISA: USD {monto:.2f} – {comercio} – {fecha}", "USD"),
+    ("alertas@interbank.com.pe", "Interbank: Compra S/{monto:.2f} {comercio} {fecha}", "PEN"),
+]
+COMERCIOS = ["TOTTUS", "NETFLIX.COM", "UBER TRIP", "MERCADO PAGO", "SPOTIFY", "WONG", "PLAZA VEA", "RAPPI"]
+PATRON_EMAIL = re.compile(r"Email: (.*)")
+PATRON_MONTO = re.compile(r"(\d+\.\d{2})")
+PATRON_FECHA = re.compile(r"(\d{4}-\d{2}-\d{2})")
+
+
+class FakeOllama:
+    """Servidor HTTP local que imita POST /api/generate de Ollama."""
+
+    def __init__(self, latency_ms: float = 0, error_rate: float = 0, seed: int = 0):
+        self.latency = latency_ms / 1000
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                with fake.lock:
+                    fake.calls += 1
+                    fail = fake.random.random() < fake.error_rate
+                    if fail:
+                        fake.errors += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if fail:
+                    payload = {"response": "lo siento, no entendí"}
+                else:
+                    payload = {"response": json.dumps(fake.parse(body.get("prompt", "")))}
+                data = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+    @staticmethod
+    def parse(prompt: str) -> dict:
+        m = PATRON_EMAIL.search(prompt)
+        text = m.group(1) if m else ""
+        monto = PATRON_MONTO.search(text)
+        fecha = PATRON_FECHA.search(text)
+        comercio = next((c for c in COMERCIOS if c in text), "Desconocido")
+        return {
+            "fecha": fecha.group(1) if fecha else "",
+            "comercio": comercio,
+            "monto": float(monto.group(1)) if monto else 0.0,
+            "moneda": "USD" if "USD" in text else "PEN",
+        }
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def synthetic_emails(n: int, seed: int = 0) -> list[dict]:
+    rnd = random.Random(seed)
+    emails = []
+    for i in range(n):
+        de, plantilla, _ = rnd.choice(BANCOS)
+        fecha = f"2025-10-{rnd.randint(1, 28):02d}"
+        cuerpo = plantilla.format(monto=rnd.uniform(1, 500), comercio=rnd.choice(COMERCIOS), fecha=fecha)
+        emails.append({"de": de, "cuerpo": f"{cuerpo} #{i}", "fecha": fecha})
+    return emails
+
+
+def write_mbox(emails: list[dict], path: str):
+    box = mailbox.mbox(path)
+    box.lock()
+    try:
+        for e in emails:
+            msg = EmailMessage()
+            msg["From"] = e["de"]
+            msg["Date"] = format_datetime(datetime.fromisoformat(e["fecha"] + "T12:00:00"))
+            msg["Subject"] = "Alerta de consumo"
+            msg.set_content(e["cuerpo"])
+            box.add(msg)
+        box.flush()
+    finally:
+        box.unlock()
+        box.close()
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[k]
+
+
+class Timings:
+    def __init__(self):
+        self.samples: dict = {}
+        self.lock = threading.Lock()
+
+    def timed(self, cmd: str, fn, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.samples.setdefault(cmd, []).append(time.perf_counter() - t0)
+
+
+def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="mcp_bench_")
+    fake = FakeOllama(args.latency_ms, args.error_rate, args.seed).start()
+    # El servidor hereda el entorno: Ollama falso y ledger temporal
+    os.environ["OLLAMA_URL"] = fake.url
+    os.environ["MCP_LEDGER"] = os.path.join(workdir, "gastos.db")
+
+    from mcp_client import MCPClient
+
+    emails = synthetic_emails(args.emails, args.seed)
+    mbox_path = os.path.join(workdir, "alertas.mbox")
+    write_mbox(emails, mbox_path)
+    out_path = os.path.join(workdir, "gastos.csv")
+
+    tracemalloc.start()
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mcp_server.py")
+    client = MCPClient(server_path, pool_size=args.pool, shared=False)
+    timings = Timings()
+    t0 = time.perf_counter()
+
+    fetched = timings.timed("fetch_emails", client.fetch_emails, "mbox", mbox_path)
+    batches = [fetched[i:i + args.batch] for i in range(0, len(fetched), args.batch)]
+    client.export_expenses([], out_path)
+
+    # Varios servidores agregan al mismo CSV: las exportaciones se serializan
+    export_lock = threading.Lock()
+
+    def process(batch):
+        handle = timings.timed("extract_expenses", client.extract_expenses, batch, handle=True)
+        with export_lock:
+            timings.timed("export_expenses", client.export_expenses, handle, out_path, "a")
+        client.release(handle)
+        return handle["n"]
+
+    with ThreadPoolExecutor(max_workers=args.pool) as executor:
+        extracted = sum(executor.map(process, batches))
+
+    for _ in range(args.summaries):
+        timings.timed("summary_today", client.summary_today)
+
+    elapsed = time.perf_counter() - t0
+    _, client_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    client.close()
+    fake.stop()
+    # ru_maxrss de hijos terminados (KB en Linux, bytes en macOS)
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    server_peak = rss if sys.platform == "darwin" else rss * 1024
+
+    return {
+        "emails": len(fetched),
+        "gastos": extracted,
+        "segundos": round(elapsed, 3),
+        "emails_por_segundo": round(len(fetched) / elapsed, 1) if elapsed else 0,
+        "llm_calls": fake.calls,
+        "llm_errores": fake.errors,
+        "latencias_ms": {
+            cmd: {
+                "n": len(v),
+                "p50": round(percentile(v, 50) * 1000, 2),
+                "p99": round(percentile(v, 99) * 1000, 2),
+            }
+            for cmd, v in timings.samples.items()
+        },
+        "memoria_pico_cliente_mb": round(client_peak / 2**20, 1),
+        "memoria_pico_servidor_mb": round(server_peak / 2**20, 1),
+        "directorio": workdir,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del pipeline MCP de gastos")
+    parser.add_argument("--emails", type=int, default=10000)
+    parser.add_argument("--batch", type=int, default=200)
+    parser.add_argument("--pool", type=int, default=1, help="procesos servidor")
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--summaries", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="imprime el reporte en JSON")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False))
+        return
+
+    print("\n📈 BENCHMARK PIPELINE MCP")
+    print("=" * 60)
+    print(f"Correos: {report['emails']} | Gastos: {report['gastos']} | Tiempo: {report['segundos']} s")
+    print(f"Throughput: {report['emails_por_segundo']} correos/s")
+    print(f"Llamadas LLM: {report['llm_calls']} ({report['llm_errores']} con error)")
+    print("-" * 60)
+    for cmd, lat in report["latencias_ms"].items():
+        print(f"  {cmd:<18} n={lat['n']:<5} p50={lat['p50']:>8} ms  p99={lat['p99']:>8} ms")
+    print("-" * 60)
+    print(f"Memoria pico: cliente {report['memoria_pico_cliente_mb']} MB | servidor {report['memoria_pico_servidor_mb']} MB")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
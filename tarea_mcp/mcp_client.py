@@ -3,84 +3,329 @@
 Cliente MCP - Consume el servidor MCP
 Se comunica via stdin/stdout
 """
+import atexit
+import itertools
 import json
 import subprocess
 import sys
 import os
-from typing import Any
+import threading
+from collections import deque
+from typing import Any, Iterable, Optional
 
-class MCPClient:
-    def __init__(self, server_path: str = "mcp_server.py"):
+import mcp_framing
+
+RESTART_ATTEMPTS = 1
+
+
+class ServerProcess:
+    """Un proceso mcp_server.py con su stderr drenado en un hilo aparte.
+
+    Sin drenar stderr el servidor se bloquea al llenar el pipe cuando loguea
+    mucho; las últimas líneas se guardan para los mensajes de error.
+    """
+
+    def __init__(self, server_path: str, index: int, framing: str = "line", encoding: str = "msgpack"):
+        self.server_path = server_path
+        self.index = index
+        self.framing = framing
+        self.requested_encoding = encoding
+        self.encoding = None    # None = línea JSON
+        # Reentrante: start() negocia el framing con request() mientras se reinicia bajo el lock
+        self.lock = threading.RLock()
+        self.inflight = 0
+        self.stderr_tail: deque = deque(maxlen=200)
+        self._ids = itertools.count(1)
+        self.start()
+
+    def start(self):
         self.process = subprocess.Popen(
-            [sys.executable, server_path],
+            [sys.executable, self.server_path],
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1
         )
+        self.encoding = None
+        self._drain = threading.Thread(target=self._drain_stderr, args=(self.process.stderr,), daemon=True)
+        self._drain.start()
+        if self.framing == "binary":
+            chosen = self.request({"cmd": "negotiate", "args": [{"framing": "binary", "encoding": self.requested_encoding}]})
+            if "error" in chosen:
+                raise RuntimeError(f"No se pudo negociar framing binario: {chosen['error']}")
+            if chosen["result"]["framing"] == "binary":
+                self.encoding = chosen["result"]["encoding"]
 
-    def send_command(self, cmd: str, args: list = None) -> Any:
-        if args is None:
-            args = []
+    def _drain_stderr(self, stream):
+        for line in stream:
+            self.stderr_tail.append(line.decode("utf-8", "replace").rstrip("\n"))
+
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def restart(self):
+        with self.lock:
+            self.stop()
+            self.start()
+
+    def ensure_alive(self) -> bool:
+        """Reinicia el proceso si murió; con el lock, dos hilos no lo reinician a la vez."""
+        with self.lock:
+            if self.alive():
+                return False
+            print(f"Servidor MCP #{self.index} caído, reiniciando...", file=sys.stderr)
+            self.restart()
+            return True
+
+    def request(self, message: dict) -> dict:
+        with self.lock:
+            req_id = next(self._ids)
+            message = {**message, "id": req_id}
+            try:
+                if self.encoding is None:
+                    self.process.stdin.write((json.dumps(message) + "\n").encode("utf-8"))
+                else:
+                    for frame in mcp_framing.frames(mcp_framing.encode(message, self.encoding)):
+                        self.process.stdin.write(frame)
+                self.process.stdin.flush()
+                if self.encoding is None:
+                    raw = self.process.stdout.readline()
+                else:
+                    raw = mcp_framing.read_message(self.process.stdout)
+            except (BrokenPipeError, OSError, ValueError):
+                raw = b""
+            if not raw:
+                tail = "\n".join(list(self.stderr_tail)[-5:])
+                raise ConnectionError(f"No response from server\n{tail}".rstrip())
+            if self.encoding is None:
+                response = json.loads(raw.strip())
+            else:
+                response = mcp_framing.decode(raw, self.encoding)
+            if response.get("id", req_id) != req_id:
+                raise RuntimeError(f"Respuesta inesperada (id {response.get('id')} != {req_id})")
+            return response
+
+    def stop(self):
+        for stream in (self.process.stdin, self.process.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class ServerPool:
+    """Pool de procesos servidor con reparto de carga y reinicio automático.
+
+    Los comandos van al proceso con menos peticiones en curso. Los handles y
+    exportaciones viven en un proceso concreto, así que esos comandos se fijan
+    al proceso que los creó (campo "$server" del handle).
+    """
+
+    def __init__(self, server_path: str, size: int = 1, framing: str = "line"):
+        self.server_path = server_path
+        self.servers = [ServerProcess(server_path, i, framing) for i in range(size)]
+        self.lock = threading.Lock()
+
+    def _pick(self) -> ServerProcess:
+        with self.lock:
+            server = min(self.servers, key=lambda s: s.inflight)
+            server.inflight += 1
+        return server
+
+    def least_loaded(self) -> int:
+        with self.lock:
+            return min(self.servers, key=lambda s: s.inflight).index
+
+    def request(self, message: dict, server_index: Optional[int] = None) -> tuple[dict, int]:
+        if server_index is None:
+            server = self._pick()
+        else:
+            server = self.servers[server_index]
+            with self.lock:
+                server.inflight += 1
+        try:
+            for attempt in range(RESTART_ATTEMPTS + 1):
+                server.ensure_alive()
+                try:
+                    return server.request(message), server.index
+                except ConnectionError:
+                    # Solo se reintenta si el proceso murió; un servidor vivo sin respuesta es un error real
+                    if attempt >= RESTART_ATTEMPTS or server.alive():
+                        raise
+        finally:
+            with self.lock:
+                server.inflight -= 1
 
-        payload = json.dumps({"cmd": cmd, "args": args})
-        self.process.stdin.write(payload + "\n")
-        self.process.stdin.flush()
+    def health_check(self) -> list[bool]:
+        """Hace ping a cada servidor y reinicia los que no respondan."""
+        status = []
+        for server in self.servers:
+            try:
+                server.ensure_alive()
+                ok = server.request({"cmd": "ping", "args": []}).get("result") == "pong"
+            except (ConnectionError, RuntimeError, ValueError):
+                ok = False
+            if not ok:
+                server.restart()
+            status.append(ok)
+        return status
+
+    def close(self):
+        for server in self.servers:
+            server.stop()
+
+
+_pools: dict = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(server_path: str = "mcp_server.py", size: int = 1, framing: str = "line") -> ServerPool:
+    """Pool compartido por ruta, tamaño y framing: varios MCPClient reutilizan procesos calientes."""
+    key = (os.path.abspath(server_path), size, framing)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ServerPool(key[0], size, framing)
+        return pool
 
-        response_line = self.process.stdout.readline()
-        if not response_line:
-            raise RuntimeError("No response from server")
 
-        response = json.loads(response_line.strip())
+@atexit.register
+def shutdown_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+def _pinned_server(args: list) -> Optional[int]:
+    for a in args:
+        if isinstance(a, dict) and "$server" in a:
+            return a["$server"]
+    return None
+
+
+class MCPClient:
+    def __init__(self, server_path: str = "mcp_server.py", pool_size: int = 1, shared: bool = True,
+                 framing: str = "line"):
+        """shared=True reutiliza el pool del proceso; shared=False crea uno propio.
+        framing="binary" negocia mensajes con prefijo de longitud (msgpack si está instalado)."""
+        self.shared = shared
+        if shared:
+            self.pool = get_pool(server_path, pool_size, framing)
+        else:
+            self.pool = ServerPool(os.path.abspath(server_path), pool_size, framing)
+
+    def send_command(self, cmd: str, args: list = None, handle: bool = False, server: Optional[int] = None) -> Any:
+        """Envía un comando. Con handle=True el servidor retiene el resultado
+        y devuelve {"$handle": ..., "n": ..., "$server": ...}, usable como argumento de otros comandos."""
+        if args is None:
+            args = []
+
+        message = {"cmd": cmd, "args": args}
+        if handle:
+            message["handle"] = True
+        if server is None:
+            server = _pinned_server(args)
+        response, index = self.pool.request(message, server)
         if "error" in response:
             raise Exception(response["error"])
-        return response.get("result")
+        result = response.get("result")
+        if handle and isinstance(result, dict):
+            result["$server"] = index
+        return result
+
+    def health_check(self) -> list[bool]:
+        return self.pool.health_check()
+
+    def stats(self, reset: bool = False) -> list[dict]:
+        """Métricas de cada servidor del pool."""
+        return [self.send_command("stats", [reset], server=i) for i in range(len(self.pool.servers))]
 
-    def fetch_emails(self, provider: str = "simulado") -> list[dict]:
-        return self.send_command("fetch_emails", [provider])
+    def fetch_emails(self, provider: str = "simulado", path: Optional[str] = None,
+                     limit: Optional[int] = None, handle: bool = False) -> Any:
+        return self.send_command("fetch_emails", [provider, path, limit], handle)
 
-    def extract_expenses(self, emails: list[dict]) -> list[dict]:
-        return self.send_command("extract_expenses", [emails])
+    def ingest_mailbox(self, provider: str, path: str, batch: int = 100) -> dict:
+        return self.send_command("ingest_mailbox", [provider, path, batch])
 
-    def export_expenses(self, rows: list[dict], path: str = "gastos.csv") -> str:
-        return self.send_command("export_expenses", [rows, path])
+    def extract_expenses(self, emails: Any, handle: bool = False) -> Any:
+        return self.send_command("extract_expenses", [emails], handle)
+
+    def fetch_handle(self, handle: dict, offset: int = 0, limit: Optional[int] = None) -> list:
+        return self.send_command("fetch_handle", [handle, offset, limit])
+
+    def release(self, *handles: dict) -> int:
+        return self.send_command("release_handle", list(handles))
+
+    def export_expenses(self, rows: Optional[Iterable[dict]] = None, path: str = "gastos.csv",
+                        mode: str = "w", formato: Optional[str] = None, chunk_size: int = 1000) -> str:
+        """Exporta gastos. Listas pequeñas van en un mensaje; iteradores y listas
+        grandes se envían por partes (export_begin/chunk/end). rows=None exporta el ledger
+        y un handle se resuelve en el servidor."""
+        if rows is None or isinstance(rows, dict) or (isinstance(rows, list) and len(rows) <= chunk_size):
+            return self.send_command("export_expenses", [rows, path, mode, formato])
+
+        # La exportación por partes vive en un proceso: todas las partes van al mismo
+        server = self.pool.least_loaded()
+        export_id = self.send_command("export_begin", [path, mode, formato], server=server)
+        try:
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= chunk_size:
+                    self.send_command("export_chunk", [export_id, batch], server=server)
+                    batch = []
+            if batch:
+                self.send_command("export_chunk", [export_id, batch], server=server)
+        except BaseException:
+            # Un fallo a mitad no debe dejar un archivo parcial como si estuviera completo
+            try:
+                self.send_command("export_abort", [export_id], server=server)
+            except Exception as e:
+                print(f"No se pudo abortar la exportación {export_id}: {e}", file=sys.stderr)
+            raise
+        return self.send_command("export_end", [export_id], server=server)
 
     def summary_today(self) -> str:
         return self.send_command("summary_today", [])
 
     def close(self):
-        self.process.stdin.close()
-        self.process.stdout.close()
-        self.process.terminate()
+        """Libera el cliente; un pool compartido queda caliente hasta salir del proceso."""
+        if not self.shared:
+            self.pool.close()
 
 if __name__ == "__main__":
     print("Iniciando cliente MCP...")
     client = MCPClient()
 
     try:
-        # 1. Obtener emails
+        # 1. Obtener emails (quedan en el servidor, solo viaja el handle)
         print("\n📧 Obteniendo correos...")
-        emails = client.fetch_emails()
-        print(f"   ✓ {len(emails)} correos obtenidos")
+        emails = client.fetch_emails(handle=True)
+        print(f"   ✓ {emails['n']} correos obtenidos")
 
         # 2. Extraer gastos
         print("\n💰 Extrayendo gastos con Llama 3.2...")
-        gastos = client.extract_expenses(emails)
-        print(f"   ✓ {len(gastos)} gastos extraídos")
+        gastos = client.extract_expenses(emails, handle=True)
+        print(f"   ✓ {gastos['n']} gastos extraídos")
 
-        if not gastos:
+        if not gastos["n"]:
             print("\n⚠️  No se extrajeron gastos. Verifica que Ollama esté corriendo:")
             print("   Terminal 1: ollama run llama2")
             sys.exit(1)
 
-        for i, g in enumerate(gastos[:3], 1):
+        for i, g in enumerate(client.fetch_handle(gastos, 0, 3), 1):
             print(f"      {i}. {g['fecha']} | {g['comercio']} | {g['monto']} {g['moneda']}")
 
         # 3. Exportar
         print("\n📁 Exportando a CSV...")
         csv_path = client.export_expenses(gastos, "gastos.csv")
         print(f"   ✓ Archivo: {csv_path}")
+        client.release(emails, gastos)
 
         # Validar que el CSV se creó
         if os.path.exists(csv_path):
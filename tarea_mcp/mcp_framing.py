@@ -0,0 +1,100 @@
+"""
+Framing binario opcional para el protocolo MCP por stdio.
+
+Por defecto cliente y servidor intercambian una línea JSON por mensaje. Tras
+negociarlo con {"cmd": "negotiate", "args": [{"framing": "binary", "encoding": "msgpack"}]}
+ambos pasan a mensajes con prefijo de longitud:
+
+    [flags: 1 byte][longitud: 4 bytes big-endian][payload]
+
+El payload es msgpack (si está instalado) o JSON compacto. Los mensajes
+grandes se parten en trozos de CHUNK_BYTES; flags=FLAG_MORE indica que
+sigue otro trozo del mismo mensaje.
+"""
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+HEADER = struct.Struct(">BI")
+FLAG_MORE = 1
+CHUNK_BYTES = 1 << 20
+MAX_MESSAGE_BYTES = 512 * 1024 * 1024
+
+
+def available_encodings() -> list[str]:
+    return ["msgpack", "json"] if msgpack is not None else ["json"]
+
+
+def choose_encoding(requested: str) -> str:
+    return requested if requested in available_encodings() else "json"
+
+
+def encode(obj, encoding: str) -> bytes:
+    if encoding == "msgpack":
+        return msgpack.packb(obj, use_bin_type=True)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def decode(payload: bytes, encoding: str):
+    if encoding == "msgpack":
+        return msgpack.unpackb(payload, raw=False)
+    return json.loads(payload)
+
+
+def frames(payload: bytes, chunk: int = CHUNK_BYTES) -> list[bytes]:
+    """Parte un payload en frames con cabecera; el último lleva flags=0."""
+    if not payload:
+        return [HEADER.pack(0, 0)]
+    out = []
+    for start in range(0, len(payload), chunk):
+        part = payload[start:start + chunk]
+        more = FLAG_MORE if start + chunk < len(payload) else 0
+        out.append(HEADER.pack(more, len(part)) + part)
+    return out
+
+
+def _check_size(total: int):
+    if total > MAX_MESSAGE_BYTES:
+        raise ValueError("Mensaje demasiado grande")
+
+
+def read_message(stream) -> bytes:
+    """Lee un mensaje completo (todos sus trozos) de un stream binario bloqueante.
+
+    Devuelve b"" si el stream se cerró.
+    """
+    parts, total = [], 0
+    while True:
+        header = stream.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return b""
+        flags, length = HEADER.unpack(header)
+        total += length
+        _check_size(total)
+        part = stream.read(length)
+        if len(part) < length:
+            return b""
+        parts.append(part)
+        if not flags & FLAG_MORE:
+            return b"".join(parts)
+
+
+async def read_message_async(reader) -> bytes:
+    """Versión asyncio de read_message para un asyncio.StreamReader."""
+    import asyncio
+
+    parts, total = [], 0
+    try:
+        while True:
+            flags, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+            total += length
+            _check_size(total)
+            parts.append(await reader.readexactly(length))
+            if not flags & FLAG_MORE:
+                return b"".join(parts)
+    except asyncio.IncompleteReadError:
+        return b""
@@ -2,12 +2,32 @@
 """
 MCP Server via stdio - Gestor de Gastos con Llama 3.2
 """
+import asyncio
+import bisect
+import contextvars
 import csv
+import email
+import email.parser
+import email.policy
+import email.utils
+import functools
+import hashlib
+import heapq
 import json
+import mailbox
+import os
 import re
+import sqlite3
+import stat
 import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from typing import Optional
+import mcp_framing
+from typing import Iterable, Iterator, Optional
 
 EMAILS = [
     {"de": "alertas@bcp.com.pe", "cuerpo": "BCP: Compra aprobada S/ 45.90 en TOTTUS 2025-10-29", "fecha": "2025-10-29"},
@@ -17,6 +37,137 @@ EMAILS = [
     {"de": "alertas@visa.com", "cuerpo": "VISA: USD 8.5 en SPOTIFY 2025-10-29", "fecha": "2025-10-29"},
 ]
 
+OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://localhost:11434")
+STATS_FILE = os.environ.get("MCP_STATS_FILE")
+
+
+class Histogram:
+    """Histograma de latencias en ms con buckets fijos."""
+
+    BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf"))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS_MS)
+        self.n = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms: float):
+        self.counts[bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+        self.n += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q: float) -> float:
+        """Cota superior del bucket que contiene el cuantil q."""
+        if not self.n:
+            return 0.0
+        target, acc = q * self.n, 0
+        for bound, count in zip(self.BUCKETS_MS, self.counts):
+            acc += count
+            if acc >= target:
+                return self.max_ms if bound == float("inf") else bound
+        return self.max_ms
+
+    def snapshot(self) -> dict:
+        return {
+            "n": self.n,
+            "avg_ms": round(self.total_ms / self.n, 3) if self.n else 0.0,
+            "max_ms": round(self.max_ms, 3),
+            "p50_ms": self.quantile(0.5),
+            "p99_ms": self.quantile(0.99),
+            "buckets": {("+inf" if b == float("inf") else f"<={b}"): c for b, c in zip(self.BUCKETS_MS, self.counts) if c},
+        }
+
+
+class Metrics:
+    """Métricas del servidor: latencia por comando, llamadas al LLM y cachés."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.commands: dict = {}
+            self.llm = Histogram()
+            self.counters: dict = {}
+
+    def observe_command(self, cmd: str, ms: float, ok: bool):
+        with self.lock:
+            entry = self.commands.setdefault(cmd, {"hist": Histogram(), "errors": 0})
+            entry["hist"].observe(ms)
+            if not ok:
+                entry["errors"] += 1
+
+    def observe_llm(self, ms: float, ok: bool):
+        with self.lock:
+            self.llm.observe(ms)
+            if not ok:
+                self.counters["llm_errors"] = self.counters.get("llm_errors", 0) + 1
+
+    def incr(self, name: str, n: int = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @staticmethod
+    def _ratio(a: int, b: int) -> float:
+        return round(a / (a + b), 4) if a + b else 0.0
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            c = dict(self.counters)
+            commands = {}
+            for cmd, entry in self.commands.items():
+                snap = entry["hist"].snapshot()
+                snap["errors"] = entry["errors"]
+                snap["error_rate"] = round(entry["errors"] / snap["n"], 4) if snap["n"] else 0.0
+                commands[cmd] = snap
+            llm = self.llm.snapshot()
+        llm["errors"] = c.get("llm_errors", 0)
+        llm["error_rate"] = round(llm["errors"] / llm["n"], 4) if llm["n"] else 0.0
+        return {
+            "uptime_s": round(time.time() - self.started, 1),
+            "commands": commands,
+            "llm": llm,
+            "extract": {
+                "ledger_hits": c.get("extract_ledger_hits", 0),
+                "llm_parses": c.get("extract_llm_parses", 0),
+                "errors": c.get("extract_errors", 0),
+                # Correos servidos desde el ledger (sin LLM) sobre el total
+                "cache_hit_rate": self._ratio(c.get("extract_ledger_hits", 0), c.get("extract_llm_parses", 0)),
+            },
+            "rates_cache_hit_rate": self._ratio(c.get("rates_cache_hits", 0), c.get("rates_cache_misses", 0)),
+        }
+
+    def dump(self, path: str) -> str:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, indent=2, ensure_ascii=False)
+        return path
+
+
+metrics = Metrics()
+
+class RequestCancelled(RuntimeError):
+    pass
+
+
+class UnknownCommand(Exception):
+    pass
+
+
+# Evento de cancelación de la petición que ejecuta el hilo actual (lo fija dispatch_command)
+_cancel_event = contextvars.ContextVar("cancel_event", default=None)
+
+
+def check_cancelled():
+    """Los handlers largos lo llaman entre pasos para cortar tras cancel/timeout."""
+    event = _cancel_event.get()
+    if event is not None and event.is_set():
+        raise RequestCancelled("Petición cancelada")
+
+
 def parse_with_llama(text: str) -> dict:
     prompt = f"""Extrae del siguiente texto de email:
 - fecha (YYYY-MM-DD)
@@ -28,102 +179,1233 @@ Email: {text}
 
 Responde en JSON: {{"fecha": "...", "comercio": "...", "monto": 0.0, "moneda": "..."}}"""
 
-    response = requests.post(
-        "http://localhost:11434/api/generate",
-        json={"model": "llama3.2", "prompt": prompt, "stream": False},
-        timeout=10
-    )
-    result = response.json()
+    t0 = time.perf_counter()
+    try:
+        response = requests.post(
+            f"{OLLAMA_URL}/api/generate",
+            json={"model": "llama3.2", "prompt": prompt, "stream": False},
+            timeout=10
+        )
+        result = response.json()
+    except Exception:
+        metrics.observe_llm((time.perf_counter() - t0) * 1000, ok=False)
+        raise
+    metrics.observe_llm((time.perf_counter() - t0) * 1000, ok=True)
     text_response = result.get("response", "").strip()
     json_match = re.search(r'\{.*\}', text_response, re.DOTALL)
     if json_match:
         return json.loads(json_match.group())
     raise ValueError("No se pudo extraer JSON")
 
-def fetch_emails(provider: str = "simulado") -> list[dict]:
-    return EMAILS
+LEDGER_PATH = os.environ.get("MCP_LEDGER", os.path.join(os.path.dirname(os.path.abspath(__file__)), "gastos.db"))
+CAMPOS = ["fecha", "comercio", "monto", "moneda", "fuente"]
+MAX_ATTEMPTS = 5    # intentos de parseo antes de dejar un correo en `pendientes` sin reintentar
+RATES_PATH = os.environ.get("MCP_RATES", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tipos_cambio.csv"))
+BASE_CURRENCY = os.environ.get("MCP_BASE_CURRENCY", "PEN").upper()
+if not re.fullmatch(r"[A-Z]{3}", BASE_CURRENCY):
+    raise ValueError(f"Moneda base inválida: {BASE_CURRENCY}")
 
-def extract_expenses(emails: list[dict]) -> list[dict]:
+
+class ExchangeRates:
+    """Tipos de cambio desde un CSV local (fecha, moneda, tasa).
+
+    `tasa` son unidades de la moneda base por 1 unidad de `moneda`. Para una
+    fecha se usa la última tasa publicada hasta ese día (o la primera si la
+    fecha es anterior a todas). Las conversiones se cachean por (moneda, fecha)
+    y el archivo se relee solo si cambia su mtime.
+    """
+
+    def __init__(self, path: str = RATES_PATH, base: str = BASE_CURRENCY):
+        self.path = path
+        self.base = base
+        self.mtime = None
+        self.rows: list[tuple] = []
+        self._series: dict = {}
+        self._cache: dict = {}
+        self.lock = threading.Lock()
+
+    def refresh(self) -> bool:
+        """Recarga el archivo si cambió; devuelve True si hubo recarga."""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        with self.lock:
+            if mtime == self.mtime:
+                return False
+            rows = []
+            if mtime is not None:
+                with open(self.path, newline="", encoding="utf-8") as f:
+                    try:
+                        for r in csv.DictReader(f):
+                            rows.append((r["fecha"], r["moneda"].upper(), float(r["tasa"])))
+                    except KeyError as e:
+                        raise ValueError(f"{self.path}: falta la columna {e.args[0]}") from None
+            series: dict = {}
+            for fecha, moneda, tasa in sorted(rows):
+                series.setdefault(moneda, ([], []))
+                series[moneda][0].append(fecha)
+                series[moneda][1].append(tasa)
+            self.rows, self._series, self._cache, self.mtime = rows, series, {}, mtime
+            return True
+
+    def rate(self, moneda: str, fecha: str) -> Optional[float]:
+        if moneda == self.base:
+            return 1.0
+        key = (moneda, fecha)
+        with self.lock:
+            if key in self._cache:
+                metrics.incr("rates_cache_hits")
+                return self._cache[key]
+            metrics.incr("rates_cache_misses")
+            serie = self._series.get(moneda)
+            tasa = None
+            if serie:
+                i = bisect.bisect_right(serie[0], fecha or "")
+                tasa = serie[1][max(i - 1, 0)]
+            self._cache[key] = tasa
+            return tasa
+
+    def convert(self, monto: float, moneda: str, fecha: str) -> Optional[float]:
+        tasa = self.rate(moneda, fecha)
+        return None if tasa is None else monto * tasa
+
+
+def email_fingerprint(mail: dict) -> str:
+    """Huella de la transacción: hash del correo de alerta que la origina."""
+    raw = "|".join([mail.get("de", ""), mail.get("fecha", ""), mail.get("cuerpo", "")])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def expense_fingerprint(row: dict) -> str:
+    """Huella para gastos que no vienen de un correo (campos normalizados)."""
+    raw = "|".join([
+        str(row.get("fecha", "")), str(row.get("comercio", "")).strip().upper(),
+        f"{float(row.get('monto') or 0):.2f}", str(row.get("moneda", "")).upper(),
+        str(row.get("fuente", "")),
+    ])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+class RunningAggregates:
+    """Agregados incrementales: totales por moneda, por comercio y top-k.
+
+    Se actualizan al ingresar cada gasto nuevo, así el resumen es O(k) en
+    lugar de recorrer todo el historial. Los totales por comercio y el top-k
+    están en la moneda base. El heap top-k es válido mientras los totales solo
+    crecen; un monto negativo (reembolso) lo marca para rehacerlo.
+    """
+
+    def __init__(self, k: int = 3):
+        self.k = k
+        self.count = 0
+        self.by_currency: dict = {}
+        self.total_base = 0.0
+        self.unconverted = 0        # gastos sin tipo de cambio
+        self.by_merchant: dict = {}
+        self._top: list = []        # min-heap de (total_base, comercio)
+        self._dirty = False
+        self.lock = threading.Lock()
+
+    def add(self, comercio: str, moneda: str, monto: float, monto_base: Optional[float], n: int = 1):
+        with self.lock:
+            self.count += n
+            self.by_currency[moneda] = self.by_currency.get(moneda, 0) + monto
+            if monto_base is None:
+                self.unconverted += n
+                return
+            self.total_base += monto_base
+            total = self.by_merchant.get(comercio, 0) + monto_base
+            self.by_merchant[comercio] = total
+            if monto_base < 0:
+                self._dirty = True
+            if self._dirty:
+                return
+            for i, (_, k) in enumerate(self._top):
+                if k == comercio:
+                    self._top[i] = (total, comercio)
+                    heapq.heapify(self._top)
+                    return
+            if len(self._top) < self.k:
+                heapq.heappush(self._top, (total, comercio))
+            elif total > self._top[0][0]:
+                heapq.heapreplace(self._top, (total, comercio))
+
+    def top(self, n: Optional[int] = None) -> list[dict]:
+        n = self.k if n is None else n
+        with self.lock:
+            if n > self.k:
+                # Fuera del heap mantenido: cálculo completo
+                best = heapq.nlargest(n, ((t, k) for k, t in self.by_merchant.items()))
+            else:
+                if self._dirty:
+                    self._top = heapq.nlargest(self.k, ((t, k) for k, t in self.by_merchant.items()))
+                    heapq.heapify(self._top)
+                    self._dirty = False
+                best = sorted(self._top, reverse=True)[:n]
+        return [{"comercio": k, "moneda": BASE_CURRENCY, "total": t} for t, k in best]
+
+    def totals(self) -> dict:
+        with self.lock:
+            return dict(sorted(self.by_currency.items()))
+
+
+class ExpenseLedger:
+    """Libro de gastos persistente en SQLite, deduplicado por huella."""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS gastos (
+        id INTEGER PRIMARY KEY,
+        huella TEXT NOT NULL UNIQUE,
+        fecha TEXT,
+        comercio TEXT,
+        monto REAL,
+        moneda TEXT,
+        fuente TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_gastos_fecha ON gastos(fecha);
+    CREATE INDEX IF NOT EXISTS idx_gastos_comercio ON gastos(comercio);
+    CREATE INDEX IF NOT EXISTS idx_gastos_moneda ON gastos(moneda, fecha);
+    CREATE TABLE IF NOT EXISTS cursores (
+        fuente TEXT PRIMARY KEY,
+        valor TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS claves_buzon (
+        fuente TEXT NOT NULL,
+        clave TEXT NOT NULL,
+        PRIMARY KEY (fuente, clave)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS pendientes (
+        huella TEXT PRIMARY KEY,
+        fuente TEXT NOT NULL,
+        correo TEXT NOT NULL,
+        intentos INTEGER NOT NULL,
+        error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_pendientes_fuente ON pendientes(fuente);
+    CREATE TABLE IF NOT EXISTS tipos_cambio (
+        moneda TEXT NOT NULL,
+        fecha TEXT NOT NULL,
+        tasa REAL NOT NULL,
+        PRIMARY KEY (moneda, fecha)
+    );
+    """
+
+    # Tasa "as of" por fila: última publicada hasta la fecha, si no la primera posterior
+    RATE_SQL = f"""(CASE WHEN g.moneda = '{BASE_CURRENCY}' THEN 1.0 ELSE COALESCE(
+        (SELECT t.tasa FROM tipos_cambio t WHERE t.moneda = g.moneda AND t.fecha <= g.fecha ORDER BY t.fecha DESC LIMIT 1),
+        (SELECT t.tasa FROM tipos_cambio t WHERE t.moneda = g.moneda ORDER BY t.fecha ASC LIMIT 1)) END)"""
+
+    def __init__(self, path: str = LEDGER_PATH):
+        self.path = path
+        # Los tools corren en hilos del executor: una conexión compartida con lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        # Serializa reconstrucción y actualización incremental de los agregados.
+        # Orden: agg_lock antes que lock.
+        self.agg_lock = threading.RLock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(self.SCHEMA)
+        self.rates = ExchangeRates()
+        self.rates_version = 0      # sube cada vez que se recarga la tabla de tipos de cambio
+        self._sync_rates()
+        self._load_aggregates()
+
+    def _sync_rates(self) -> bool:
+        """Copia el archivo de tipos de cambio a la tabla si cambió."""
+        if not self.rates.refresh():
+            return False
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM tipos_cambio")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO tipos_cambio (fecha, moneda, tasa) VALUES (?, ?, ?)", self.rates.rows
+            )
+            self.rates_version += 1
+        return True
+
+    def _data_version(self) -> int:
+        with self.lock:
+            return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _load_aggregates(self):
+        with self.agg_lock:
+            self._seen_version = self._data_version()
+            self._aggregates_rates = self.rates_version
+            aggregates = RunningAggregates()
+            rows = self._query(
+                f"SELECT comercio, moneda, SUM(monto) AS total, SUM(monto * {self.RATE_SQL}) AS total_base, "
+                "COUNT(*) AS n FROM gastos g GROUP BY comercio, moneda"
+            )
+            for r in rows:
+                aggregates.add(r["comercio"], r["moneda"], r["total"], r["total_base"], r["n"])
+            self.aggregates = aggregates
+
+    def fresh_aggregates(self) -> RunningAggregates:
+        """Agregados al día: si otro proceso (p. ej. otro servidor del pool)
+        escribió en la base, `data_version` cambia y se recargan; igual si
+        cambió el archivo de tipos de cambio, sin importar qué consulta lo
+        sincronizó (se compara la versión de tasas con la que se armaron)."""
+        with self.agg_lock:
+            self._sync_rates()
+            if self._aggregates_rates != self.rates_version or self._data_version() != self._seen_version:
+                self._load_aggregates()
+            return self.aggregates
+
+    def _query(self, sql: str, params: tuple = ()) -> list[dict]:
+        with self.lock:
+            return [dict(r) for r in self.conn.execute(sql, params).fetchall()]
+
+    def get_cursor(self, fuente: str) -> Optional[dict]:
+        rows = self._query("SELECT valor FROM cursores WHERE fuente = ?", (fuente,))
+        return json.loads(rows[0]["valor"]) if rows else None
+
+    def set_cursor(self, fuente: str, valor: dict):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO cursores (fuente, valor) VALUES (?, ?)", (fuente, json.dumps(valor)))
+
+    def seen_keys(self, fuente: str) -> set[str]:
+        """Claves Maildir ya procesadas para la fuente."""
+        return {r["clave"] for r in self._query("SELECT clave FROM claves_buzon WHERE fuente = ?", (fuente,))}
+
+    def mark_keys(self, fuente: str, claves: Iterable[str]):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO claves_buzon (fuente, clave) VALUES (?, ?)", [(fuente, c) for c in claves]
+            )
+
+    def add_pending(self, fuente: str, fallidos: list[tuple[dict, str]]):
+        """Guarda correos cuyo parseo falló para reintentarlos; si ya estaban suma un intento."""
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO pendientes (huella, fuente, correo, intentos, error) VALUES (?, ?, ?, 1, ?) "
+                "ON CONFLICT(huella) DO UPDATE SET intentos = intentos + 1, error = excluded.error",
+                [(email_fingerprint(m), fuente, json.dumps(m), err) for m, err in fallidos],
+            )
+
+    def pending(self, fuente: str) -> list[dict]:
+        """Correos a reintentar; los que agotaron MAX_ATTEMPTS quedan en la tabla para revisarlos."""
+        rows = self._query(
+            "SELECT correo FROM pendientes WHERE fuente = ? AND intentos < ? ORDER BY rowid", (fuente, MAX_ATTEMPTS)
+        )
+        return [json.loads(r["correo"]) for r in rows]
+
+    def exhausted(self, fuente: str) -> int:
+        rows = self._query(
+            "SELECT COUNT(*) AS n FROM pendientes WHERE fuente = ? AND intentos >= ?", (fuente, MAX_ATTEMPTS)
+        )
+        return rows[0]["n"]
+
+    def drop_pending(self, huellas: Iterable[str]):
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM pendientes WHERE huella = ?", [(h,) for h in huellas])
+
+    def get(self, huella: str) -> Optional[dict]:
+        rows = self._query(f"SELECT {', '.join(CAMPOS)} FROM gastos WHERE huella = ?", (huella,))
+        return rows[0] if rows else None
+
+    def add_many(self, rows: list[dict], huellas: Optional[list[str]] = None) -> int:
+        """Inserta gastos ignorando duplicados; devuelve cuántos eran nuevos."""
+        if huellas is None:
+            huellas = [expense_fingerprint(r) for r in rows]
+        params = [
+            (h, r.get("fecha"), r.get("comercio"), float(r.get("monto") or 0), r.get("moneda"), r.get("fuente"))
+            for h, r in zip(huellas, rows)
+        ]
+        inserted = []
+        # Insert y suma incremental bajo agg_lock: una reconstrucción concurrente ve
+        # las filas nuevas ya sumadas o todavía no insertadas, nunca contadas dos veces
+        with self.agg_lock:
+            with self.lock, self.conn:
+                for p in params:
+                    cur = self.conn.execute(
+                        "INSERT OR IGNORE INTO gastos (huella, fecha, comercio, monto, moneda, fuente) VALUES (?, ?, ?, ?, ?, ?)",
+                        p,
+                    )
+                    if cur.rowcount:
+                        inserted.append(p)
+            # Con tasas nuevas aún no aplicadas a los agregados, fresh_aggregates los rehará
+            if self._aggregates_rates == self.rates_version:
+                for _, fecha, comercio, monto, moneda, _ in inserted:
+                    self.aggregates.add(comercio, moneda, monto, self.rates.convert(monto, moneda, fecha))
+        return len(inserted)
+
+    @staticmethod
+    def _where(desde: Optional[str], hasta: Optional[str], moneda: Optional[str]) -> tuple[str, tuple]:
+        conds, params = [], []
+        if desde:
+            conds.append("fecha >= ?")
+            params.append(desde)
+        if hasta:
+            conds.append("fecha <= ?")
+            params.append(hasta)
+        if moneda:
+            conds.append("moneda = ?")
+            params.append(moneda)
+        return (" WHERE " + " AND ".join("g." + c for c in conds)) if conds else "", tuple(params)
+
+    def between(self, desde: Optional[str] = None, hasta: Optional[str] = None, moneda: Optional[str] = None) -> list[dict]:
+        where, params = self._where(desde, hasta, moneda)
+        return self._query(f"SELECT {', '.join(CAMPOS)} FROM gastos g{where} ORDER BY fecha, id", params)
+
+    def iter_rows(self, desde: Optional[str] = None, hasta: Optional[str] = None,
+                  moneda: Optional[str] = None, batch: int = 1000) -> Iterator[dict]:
+        """Recorre el ledger por lotes (paginación por id) sin materializarlo."""
+        where, params = self._where(desde, hasta, moneda)
+        where = (where + " AND" if where else " WHERE") + " g.id > ?"
+        last_id = 0
+        while True:
+            rows = self._query(
+                f"SELECT id, {', '.join(CAMPOS)} FROM gastos g{where} ORDER BY id LIMIT ?",
+                params + (last_id, batch),
+            )
+            if not rows:
+                return
+            last_id = rows[-1]["id"]
+            for r in rows:
+                del r["id"]
+                yield r
+
+    def count(self, desde: Optional[str] = None, hasta: Optional[str] = None) -> int:
+        where, params = self._where(desde, hasta, None)
+        return self._query(f"SELECT COUNT(*) AS n FROM gastos g{where}", params)[0]["n"]
+
+    def totals_by_currency(self, desde: Optional[str] = None, hasta: Optional[str] = None) -> dict:
+        where, params = self._where(desde, hasta, None)
+        rows = self._query(f"SELECT moneda, SUM(monto) AS total FROM gastos g{where} GROUP BY moneda ORDER BY moneda", params)
+        return {r["moneda"]: r["total"] for r in rows}
+
+    def total_base(self, desde: Optional[str] = None, hasta: Optional[str] = None) -> tuple[float, int]:
+        """Total en moneda base y cantidad de gastos sin tipo de cambio."""
+        self._sync_rates()
+        where, params = self._where(desde, hasta, None)
+        row = self._query(
+            f"SELECT SUM(monto * {self.RATE_SQL}) AS total, SUM({self.RATE_SQL} IS NULL) AS sin_tasa FROM gastos g{where}",
+            params,
+        )[0]
+        return row["total"] or 0.0, row["sin_tasa"] or 0
+
+    def totals_by_merchant(self, desde: Optional[str] = None, hasta: Optional[str] = None,
+                           moneda: Optional[str] = None, limit: Optional[int] = None) -> list[dict]:
+        """Totales por comercio convertidos a la moneda base (conversión por fila en SQL)."""
+        self._sync_rates()
+        where, params = self._where(desde, hasta, moneda)
+        sql = (
+            f"SELECT comercio, '{BASE_CURRENCY}' AS moneda, SUM(monto * {self.RATE_SQL}) AS total, COUNT(*) AS n "
+            f"FROM gastos g{where} GROUP BY comercio HAVING total IS NOT NULL ORDER BY total DESC"
+        )
+        if limit is not None:
+            sql += " LIMIT ?"
+            params += (int(limit),)
+        return self._query(sql, params)
+
+
+_ledger: Optional[ExpenseLedger] = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger() -> ExpenseLedger:
+    global _ledger
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = ExpenseLedger()
+        return _ledger
+
+
+BANK_DOMAINS = tuple(os.environ.get(
+    "MCP_BANK_DOMAINS", "bcp.com.pe,visa.com,mastercard.pe,interbank.com.pe,bbva.pe,scotiabank.com.pe"
+).split(","))
+MAX_BODY_CHARS = 2000
+
+
+def is_bank_sender(sender: str) -> bool:
+    addr = email.utils.parseaddr(sender)[1].lower()
+    domain = addr.rsplit("@", 1)[-1]
+    return any(domain == d or domain.endswith("." + d) for d in BANK_DOMAINS)
+
+
+def _header_date(headers) -> str:
+    try:
+        return email.utils.parsedate_to_datetime(headers.get("Date", "")).date().isoformat()
+    except (TypeError, ValueError):
+        return ""
+
+
+def _message_to_email(raw: bytes, headers) -> dict:
+    """Decodifica el cuerpo solo para mensajes que pasaron el filtro de remitente."""
+    msg = email.message_from_bytes(raw, policy=email.policy.default)
+    part = msg.get_body(preferencelist=("plain", "html"))
+    cuerpo = part.get_content() if part is not None else ""
+    return {
+        "de": email.utils.parseaddr(headers.get("From", ""))[1],
+        "cuerpo": " ".join(cuerpo.split())[:MAX_BODY_CHARS],
+        "fecha": _header_date(headers),
+    }
+
+
+def _decode_alert(raw: bytes, headers) -> dict:
+    """Como _message_to_email, pero un correo mal codificado (charset desconocido,
+    MIME roto) no corta el recorrido: el cuerpo se lee como UTF-8 tolerante y el
+    error va en la clave "error" para que ingest_mailbox lo deje en `pendientes`."""
+    try:
+        return _message_to_email(raw, headers)
+    except Exception as e:
+        body = re.split(rb"\r?\n\r?\n", raw, maxsplit=1)[-1].decode("utf-8", "replace")
+        return {
+            "de": email.utils.parseaddr(headers.get("From", ""))[1],
+            "cuerpo": " ".join(body.split())[:MAX_BODY_CHARS],
+            "fecha": _header_date(headers),
+            "error": f"No se pudo decodificar: {e!r}",
+        }
+
+
+def _mailbox_source(provider: str, path: str) -> str:
+    return f"{provider}:{os.path.abspath(path)}"
+
+
+def iter_mailbox(provider: str, path: str, cursor: Optional[dict] = None,
+                 seen: Optional[set] = None) -> Iterator[tuple[dict, dict]]:
+    """Recorre un mbox/Maildir de forma perezosa desde el cursor dado.
+
+    Produce (correo, cursor_siguiente). Los remitentes se filtran leyendo solo
+    las cabeceras; el cuerpo se decodifica únicamente para alertas bancarias.
+    mbox: el cursor es el índice del mensaje (se reinicia si el archivo se achica).
+    Maildir: se saltan las claves de `seen` (ya procesadas) y cursor_siguiente es
+    {"key": clave}. No basta una clave máxima: el correo puede entregarse fuera de
+    orden (otro host, reloj atrasado, movido tarde desde tmp/).
+    Un correo que no se puede decodificar se produce igual, con su error en "error".
+    """
+    parser = email.parser.BytesHeaderParser()
+    cursor = cursor or {}
+    if provider == "mbox":
+        box = mailbox.mbox(path, create=False)
+        size = os.path.getsize(path)
+        start = cursor.get("index", 0) if size >= cursor.get("size", 0) else 0
+        try:
+            for i, key in enumerate(box.iterkeys()):
+                if i < start:
+                    continue
+                raw = box.get_bytes(key)
+                headers = parser.parsebytes(raw, headersonly=True)
+                nxt = {"index": i + 1, "size": size}
+                if is_bank_sender(headers.get("From", "")):
+                    yield _decode_alert(raw, headers), nxt
+                else:
+                    yield None, nxt
+        finally:
+            box.close()
+    elif provider == "maildir":
+        box = mailbox.Maildir(path, factory=None, create=False)
+        seen = seen or set()
+        for key in sorted(k for k in box.iterkeys() if k not in seen):
+            with box.get_file(key) as f:
+                raw = f.read()
+            headers = parser.parsebytes(raw, headersonly=True)
+            nxt = {"key": key}
+            if is_bank_sender(headers.get("From", "")):
+                yield _decode_alert(raw, headers), nxt
+            else:
+                yield None, nxt
+    else:
+        raise ValueError(f"Proveedor no soportado: {provider}")
+
+
+def _mailbox_position(ledger: ExpenseLedger, provider: str, path: str) -> tuple[Optional[dict], Optional[set]]:
+    """(cursor, claves vistas) con que retomar el buzón."""
+    source = _mailbox_source(provider, path)
+    cursor = ledger.get_cursor(source)
+    if provider != "maildir":
+        return cursor, None
+    if cursor and "key" in cursor:
+        # Cursor antiguo de clave máxima: lo anterior cuenta como procesado
+        box = mailbox.Maildir(path, factory=None, create=False)
+        ledger.mark_keys(source, (k for k in box.iterkeys() if k <= cursor["key"]))
+        ledger.set_cursor(source, {})
+    return None, ledger.seen_keys(source)
+
+
+def fetch_emails(provider: str = "simulado", path: Optional[str] = None, limit: Optional[int] = None) -> list[dict]:
+    """Correos de alertas pendientes. Para mbox/Maildir lee desde el cursor sin avanzarlo."""
+    if provider == "simulado":
+        return EMAILS
+    if not path:
+        raise ValueError(f"El proveedor {provider} requiere la ruta del buzón")
+    cursor, seen = _mailbox_position(get_ledger(), provider, path)
+    emails = []
+    for mail, _ in iter_mailbox(provider, path, cursor, seen):
+        if mail is None or "error" in mail:
+            continue
+        emails.append(mail)
+        if limit is not None and len(emails) >= limit:
+            break
+    return emails
+
+
+def ingest_mailbox(provider: str, path: str, batch: int = 100) -> dict:
+    """Procesa un buzón completo en lotes y avanza el cursor tras cada lote.
+
+    Memoria acotada a `batch` correos; una nueva ejecución solo toca correo nuevo.
+    Las alertas que Llama no pudo parsear quedan en la tabla `pendientes` y se
+    reintentan al inicio de la siguiente ejecución, así el cursor puede avanzar
+    sin perderlas.
+    """
+    ledger = get_ledger()
+    source = _mailbox_source(provider, path)
+    stats = {"mensajes": 0, "alertas": 0, "gastos": 0, "reintentados": 0, "fallidos": 0, "ilegibles": 0}
+
+    retry = ledger.pending(source)
+    if retry:
+        gastos, fallidos = _extract(retry)
+        failed = {email_fingerprint(m) for m, _ in fallidos}
+        ledger.drop_pending(email_fingerprint(m) for m in retry if email_fingerprint(m) not in failed)
+        ledger.add_pending(source, fallidos)
+        stats["reintentados"] = len(retry)
+        stats["gastos"] += len(gastos)
+        stats["fallidos"] += len(fallidos)
+
+    def flush(mails: list[dict]):
+        gastos, fallidos = _extract(mails)
+        if fallidos:
+            ledger.add_pending(source, fallidos)
+        stats["alertas"] += len(mails)
+        stats["gastos"] += len(gastos)
+        stats["fallidos"] += len(fallidos)
+
+    def advance():
+        if provider == "maildir":
+            ledger.mark_keys(source, claves)
+            claves.clear()
+        elif cursor:
+            ledger.set_cursor(source, cursor)
+
+    cursor, seen = _mailbox_position(ledger, provider, path)
+    pending, claves = [], []
+    for mail, nxt in iter_mailbox(provider, path, cursor, seen):
+        check_cancelled()
+        stats["mensajes"] += 1
+        if mail is not None and "error" in mail:
+            # Se guarda con el cuerpo tolerante: el reintento puede parsearlo igual
+            error = mail.pop("error")
+            ledger.add_pending(source, [(mail, error)])
+            stats["ilegibles"] += 1
+        elif mail is not None:
+            pending.append(mail)
+        cursor = nxt
+        if provider == "maildir":
+            claves.append(nxt["key"])
+        if len(pending) >= batch or len(claves) >= batch:
+            if pending:
+                flush(pending)
+            pending = []
+            advance()
+    if pending:
+        flush(pending)
+    advance()
+    stats["pendientes"] = len(ledger.pending(source))
+    stats["agotados"] = ledger.exhausted(source)
+    return stats
+
+
+def _extract(emails: list[dict]) -> tuple[list[dict], list[tuple[dict, str]]]:
+    """Extrae y guarda gastos. Devuelve (gastos, [(correo, error)] de los que fallaron)."""
+    ledger = get_ledger()
     gastos = []
-    errors = []
-    for email in emails:
+    fallidos = []
+    nuevos, huellas = [], []
+    for mail in emails:
+        try:
+            check_cancelled()
+        except RequestCancelled:
+            # Lo ya parseado se guarda: reintentar no repite esas llamadas a Llama
+            if nuevos:
+                ledger.add_many(nuevos, huellas)
+            raise
+        huella = email_fingerprint(mail)
+        guardado = ledger.get(huella)
+        if guardado is not None:
+            # Ya procesado: se sirve desde el ledger sin llamar a Llama
+            gastos.append(guardado)
+            metrics.incr("extract_ledger_hits")
+            continue
         try:
-            data = parse_with_llama(email["cuerpo"])
-            data["fuente"] = email["de"].split("@")[0].upper()
+            data = parse_with_llama(mail["cuerpo"])
+            data["fuente"] = mail["de"].split("@")[0].upper()
             gastos.append(data)
+            nuevos.append(data)
+            huellas.append(huella)
+            metrics.incr("extract_llm_parses")
         except Exception as e:
-            errors.append(str(e))
+            fallidos.append((mail, str(e)))
+            metrics.incr("extract_errors")
             print(f"Error procesando email: {e}", file=sys.stderr)
             continue
 
-    if errors and not gastos:
-        raise RuntimeError(f"Ollama no disponible. Asegúrate de ejecutar: ollama run llama2\nError: {errors[0]}")
+    if nuevos:
+        ledger.add_many(nuevos, huellas)
+    return gastos, fallidos
 
+
+def extract_expenses(emails: list[dict]) -> list[dict]:
+    gastos, fallidos = _extract(emails)
+    if fallidos and not gastos:
+        raise RuntimeError(f"Ollama no disponible. Asegúrate de ejecutar: ollama run llama2\nError: {fallidos[0][1]}")
     return gastos
 
-def export_expenses(rows: list[dict], path: str = "gastos.csv") -> str:
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=["fecha", "comercio", "monto", "moneda", "fuente"])
-        writer.writeheader()
-        if rows:
-            writer.writerows(rows)
-    print(f"CSV creado: {path} ({len(rows)} filas)", file=sys.stderr)
+EXPORT_BATCH = 5000
+
+
+class CsvSink:
+    def __init__(self, path: str, mode: str = "w"):
+        write_header = True
+        if mode == "a" and os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, newline="", encoding="utf-8") as f:
+                header = next(csv.reader(f), [])
+            if header != CAMPOS:
+                raise ValueError(f"Cabecera incompatible en {path}: {header}")
+            write_header = False
+        self.f = open(path, mode, newline="", encoding="utf-8")
+        self.writer = csv.DictWriter(self.f, fieldnames=CAMPOS, extrasaction="ignore")
+        if write_header:
+            self.writer.writeheader()
+
+    def write_batch(self, rows: list[dict]):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.f.close()
+
+
+class ArrowSink:
+    """Salida columnar comprimida: Parquet (.parquet) o Arrow IPC (.arrow/.feather)."""
+
+    def __init__(self, path: str, formato: str):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("El formato columnar requiere pyarrow: pip install pyarrow")
+        self.pa = pa
+        self.schema = pa.schema([
+            ("fecha", pa.string()), ("comercio", pa.string()), ("monto", pa.float64()),
+            ("moneda", pa.string()), ("fuente", pa.string()),
+        ])
+        if formato == "parquet":
+            self.writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+        else:
+            self.sink = pa.OSFile(path, "wb")
+            options = pa.ipc.IpcWriteOptions(compression="zstd")
+            self.writer = pa.ipc.new_file(self.sink, self.schema, options=options)
+
+    def write_batch(self, rows: list[dict]):
+        columns = {c: [r.get(c) for r in rows] for c in CAMPOS}
+        columns["monto"] = [float(m) if m is not None else None for m in columns["monto"]]
+        self.writer.write_table(self.pa.Table.from_pydict(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+        if hasattr(self, "sink"):
+            self.sink.close()
+
+
+def _detect_format(path: str, formato: Optional[str]) -> str:
+    if formato:
+        return formato
+    ext = os.path.splitext(path)[1].lower()
+    return {".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow"}.get(ext, "csv")
+
+
+def _open_sink(path: str, mode: str, formato: Optional[str]):
+    if mode not in ("w", "a"):
+        raise ValueError(f"Modo no soportado: {mode}")
+    formato = _detect_format(path, formato)
+    if formato == "csv":
+        return CsvSink(path, mode)
+    if formato in ("parquet", "arrow"):
+        if mode == "a":
+            raise ValueError("El modo append solo está soportado para CSV")
+        return ArrowSink(path, formato)
+    raise ValueError(f"Formato no soportado: {formato}")
+
+
+def _batched(rows: Iterable[dict], size: int) -> Iterator[list[dict]]:
+    batch = []
+    for r in rows:
+        batch.append(r)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def export_expenses(rows: Optional[Iterable[dict]] = None, path: str = "gastos.csv",
+                    mode: str = "w", formato: Optional[str] = None) -> str:
+    """Exporta gastos por lotes. Con rows=None exporta el ledger completo en streaming."""
+    if rows is None:
+        rows = get_ledger().iter_rows()
+    sink = _open_sink(path, mode, formato)
+    total = 0
+    try:
+        for batch in _batched(rows, EXPORT_BATCH):
+            sink.write_batch(batch)
+            total += len(batch)
+    finally:
+        sink.close()
+    print(f"Archivo exportado: {path} ({total} filas)", file=sys.stderr)
     return path
 
-def summary_today() -> str:
-    emails = fetch_emails()
-    gastos = extract_expenses(emails)
+# Exportaciones en curso enviadas en varios mensajes (export_begin/chunk/end)
+_exports: dict = {}
+_exports_lock = threading.Lock()
+EXPORT_IDLE_SECONDS = 600   # una exportación sin partes en este tiempo se cierra (cliente caído)
 
-    if not gastos:
-        return "No hay gastos."
 
-    totales = {}
-    comercios = {}
-    for g in gastos:
-        totales[g["moneda"]] = totales.get(g["moneda"], 0) + g["monto"]
-        comercios[g["comercio"]] = comercios.get(g["comercio"], 0) + g["monto"]
+def _discard_export(export_id: str):
+    """Cierra y olvida una exportación abierta; el archivo queda como esté."""
+    with _exports_lock:
+        export = _exports.pop(export_id, None)
+    if export is None:
+        return
+    with export["lock"]:
+        try:
+            export["sink"].close()
+        except Exception as e:
+            print(f"Error cerrando exportación {export_id}: {e}", file=sys.stderr)
+    metrics.incr("exports_discarded")
+
+
+def _expire_exports():
+    limit = time.monotonic() - EXPORT_IDLE_SECONDS
+    with _exports_lock:
+        stale = [eid for eid, e in _exports.items() if e["touched"] < limit]
+    for export_id in stale:
+        print(f"Exportación {export_id} abandonada, se cierra", file=sys.stderr)
+        _discard_export(export_id)
+
+def export_begin(path: str = "gastos.csv", mode: str = "w", formato: Optional[str] = None) -> str:
+    _expire_exports()
+    export_id = uuid.uuid4().hex
+    sink = _open_sink(path, mode, formato)
+    with _exports_lock:
+        _exports[export_id] = {"sink": sink, "path": path, "rows": 0, "lock": threading.Lock(),
+                               "touched": time.monotonic()}
+    return export_id
+
+def export_chunk(export_id: str, rows: list[dict]) -> int:
+    export = _exports.get(export_id)
+    if export is None:
+        raise ValueError(f"Exportación desconocida: {export_id}")
+    try:
+        with export["lock"]:
+            export["sink"].write_batch(rows)
+            export["rows"] += len(rows)
+            export["touched"] = time.monotonic()
+            return export["rows"]
+    except Exception:
+        # Una parte fallida deja la exportación inconsistente: se cierra y export_end la rechazará
+        _discard_export(export_id)
+        raise
+
+def export_end(export_id: str) -> str:
+    with _exports_lock:
+        export = _exports.pop(export_id, None)
+    if export is None:
+        raise ValueError(f"Exportación desconocida: {export_id}")
+    with export["lock"]:
+        export["sink"].close()
+    print(f"Archivo exportado: {export['path']} ({export['rows']} filas)", file=sys.stderr)
+    return export["path"]
+
+def export_abort(export_id: str) -> bool:
+    """Descarta una exportación por partes que el cliente no pudo completar."""
+    known = export_id in _exports
+    _discard_export(export_id)
+    return known
+
+def summary_today(desde: Optional[str] = None, hasta: Optional[str] = None) -> str:
+    """Resumen del ledger. Solo lee: la ingesta es explícita (extract_expenses / ingest_mailbox)."""
+    ledger = get_ledger()
 
-    top3 = sorted(comercios.items(), key=lambda x: x[1], reverse=True)[:3]
+    if desde or hasta:
+        n = ledger.count(desde, hasta)
+        totales = ledger.totals_by_currency(desde, hasta)
+        total_base, sin_tasa = ledger.total_base(desde, hasta)
+        top3 = ledger.totals_by_merchant(desde, hasta, limit=3)
+    else:
+        # Sin filtros: agregados en memoria, O(k)
+        agg = ledger.fresh_aggregates()
+        n, totales, top3 = agg.count, agg.totals(), agg.top(3)
+        total_base, sin_tasa = agg.total_base, agg.unconverted
 
-    res = f"📊 RESUMEN ({len(gastos)} transacciones):\n"
+    if not n:
+        return "No hay gastos."
+
+    res = f"📊 RESUMEN ({n} transacciones):\n"
     for moneda, total in totales.items():
         res += f"   {moneda}: {total:.2f}\n"
-    res += "Top 3:\n"
-    for i, (comercio, monto) in enumerate(top3, 1):
-        res += f"   {i}. {comercio}: {monto:.2f}\n"
+    res += f"   Total en {BASE_CURRENCY}: {total_base:.2f}\n"
+    if sin_tasa:
+        res += f"   ({sin_tasa} gastos sin tipo de cambio excluidos)\n"
+    res += f"Top 3 ({BASE_CURRENCY}):\n"
+    for i, row in enumerate(top3, 1):
+        res += f"   {i}. {row['comercio']}: {row['total']:.2f}\n"
     return res
 
-def process_command(cmd: str, args: list) -> str:
+def expenses_between(desde: Optional[str] = None, hasta: Optional[str] = None, moneda: Optional[str] = None) -> list[dict]:
+    return get_ledger().between(desde, hasta, moneda)
+
+def merchant_totals(desde: Optional[str] = None, hasta: Optional[str] = None, moneda: Optional[str] = None) -> list[dict]:
+    return get_ledger().totals_by_merchant(desde, hasta, moneda)
+
+def top_merchants(n: int = 3, desde: Optional[str] = None, hasta: Optional[str] = None, moneda: Optional[str] = None) -> list[dict]:
+    if not (desde or hasta or moneda):
+        return get_ledger().fresh_aggregates().top(n)
+    return get_ledger().totals_by_merchant(desde, hasta, moneda, limit=n)
+
+class ResultStore:
+    """Resultados retenidos en el servidor y referenciados por handle opaco.
+
+    Un argumento {"$handle": "..."} se reemplaza por el objeto guardado antes
+    de ejecutar el tool, así los datos grandes no cruzan el pipe stdio.
+    Se descartan los handles menos usados al superar max_items.
+    """
+
+    def __init__(self, max_items: int = 64):
+        self.max_items = max_items
+        self.items: "OrderedDict[str, object]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def put(self, value) -> dict:
+        handle = "h_" + uuid.uuid4().hex[:16]
+        with self.lock:
+            self.items[handle] = value
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+        return {"$handle": handle, "n": len(value) if hasattr(value, "__len__") else None}
+
+    def get(self, handle: str):
+        with self.lock:
+            if handle not in self.items:
+                raise ValueError(f"Handle desconocido o expirado: {handle}")
+            self.items.move_to_end(handle)
+            return self.items[handle]
+
+    def release(self, handle: str) -> bool:
+        with self.lock:
+            return self.items.pop(handle, None) is not None
+
+    def resolve(self, args: list) -> list:
+        return [self.get(a["$handle"]) if isinstance(a, dict) and "$handle" in a else a for a in args]
+
+
+results = ResultStore()
+
+def ping() -> str:
+    return "pong"
+
+def stats(reset: bool = False) -> dict:
+    snapshot = metrics.snapshot()
+    if reset:
+        metrics.reset()
+    return snapshot
+
+def dump_stats(path: Optional[str] = None) -> str:
+    path = path or STATS_FILE or "mcp_stats.json"
+    return metrics.dump(path)
+
+def fetch_handle(handle: dict, offset: int = 0, limit: Optional[int] = None) -> list:
+    """Devuelve una página de un resultado retenido (handle ya resuelto)."""
+    end = None if limit is None else offset + limit
+    return list(handle[offset:end])
+
+def release_handle(*handles: str) -> int:
+    return sum(results.release(h["$handle"] if isinstance(h, dict) else h) for h in handles)
+
+TOOLS = {
+    "fetch_emails": fetch_emails,
+    "extract_expenses": extract_expenses,
+    "export_expenses": export_expenses,
+    "export_begin": export_begin,
+    "export_chunk": export_chunk,
+    "export_end": export_end,
+    "export_abort": export_abort,
+    "summary_today": summary_today,
+    "expenses_between": expenses_between,
+    "merchant_totals": merchant_totals,
+    "top_merchants": top_merchants,
+    "ingest_mailbox": ingest_mailbox,
+    "ping": ping,
+    "stats": stats,
+    "dump_stats": dump_stats,
+    "fetch_handle": fetch_handle,
+    "release_handle": release_handle,
+}
+
+# Timeout por comando (segundos); None = sin límite
+COMMAND_TIMEOUTS = {
+    "fetch_emails": 30,
+    "extract_expenses": 600,
+    "export_expenses": 600,
+    "export_begin": 30,
+    "export_chunk": 120,
+    "export_end": 30,
+    "export_abort": 30,
+    "summary_today": 600,
+    "expenses_between": 60,
+    "merchant_totals": 60,
+    "top_merchants": 60,
+    "ingest_mailbox": None,
+    "ping": 5,
+    "stats": 5,
+    "dump_stats": 30,
+    "fetch_handle": 30,
+    "release_handle": 30,
+}
+DEFAULT_TIMEOUT = 60
+MAX_WORKERS = 4           # comandos ejecutándose a la vez
+MAX_PENDING = 32          # cola máxima antes de dejar de leer stdin (backpressure)
+MAX_LINE_BYTES = 64 * 1024 * 1024
+
+
+class ThreadedStdinReader:
+    """Lector de stdin para cuando no es pipe, socket ni TTY (p. ej. `< cmds.jsonl`).
+
+    connect_read_pipe rechaza los ficheros regulares, así que cada lectura
+    bloqueante va al executor por defecto. Expone lo que usan read_message y
+    mcp_framing.read_message_async: readline() y readexactly().
+    """
+
+    def __init__(self, stream, limit: int = MAX_LINE_BYTES):
+        self.stream = stream
+        self.limit = limit
+
+    def _readline(self) -> bytes:
+        line = self.stream.readline(self.limit + 1)
+        if len(line) > self.limit and not line.endswith(b"\n"):
+            # Igual que StreamReader: descarta el resto de la línea y falla
+            while line and not line.endswith(b"\n"):
+                line = self.stream.readline(self.limit)
+            raise ValueError("Línea demasiado larga")
+        return line
+
+    async def readline(self) -> bytes:
+        return await asyncio.get_running_loop().run_in_executor(None, self._readline)
+
+    async def readexactly(self, n: int) -> bytes:
+        data = await asyncio.get_running_loop().run_in_executor(None, self.stream.read, n)
+        if len(data) < n:
+            raise asyncio.IncompleteReadError(data, n)
+        return data
+
+
+def _stdin_is_pipe(stream) -> bool:
+    """True si connect_read_pipe acepta el stream (pipe, socket o TTY)."""
+    mode = os.fstat(stream.fileno()).st_mode
+    return stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode) or stream.isatty()
+
+
+async def dispatch_command(cmd: str, args: list, timeout: Optional[float] = None, as_handle: bool = False,
+                           executor: Optional[ThreadPoolExecutor] = None):
+    """Ejecuta un tool como corrutina; los handlers síncronos van a `executor`.
+
+    Los argumentos {"$handle": ...} se resuelven contra `results`; con
+    as_handle=True el resultado queda en el servidor y se devuelve su handle.
+
+    Al cancelar o vencer el timeout se marca el evento de cancelación del
+    handler: los largos (extract_expenses, ingest_mailbox) lo revisan con
+    check_cancelled() y se detienen en el siguiente paso.
+    """
+    handler = TOOLS.get(cmd)
+    if handler is None:
+        raise UnknownCommand(f"Unknown command: {cmd}")
+    # release_handle recibe los handles sin resolver
+    if cmd != "release_handle":
+        args = results.resolve(args)
+    cancel_event = threading.Event()
+    if asyncio.iscoroutinefunction(handler):
+        coro = handler(*args)
+    else:
+        ctx = contextvars.copy_context()
+        ctx.run(_cancel_event.set, cancel_event)
+        loop = asyncio.get_running_loop()
+        coro = loop.run_in_executor(executor, functools.partial(ctx.run, handler, *args))
+    if timeout is None:
+        timeout = COMMAND_TIMEOUTS.get(cmd, DEFAULT_TIMEOUT)
+    t0 = time.perf_counter()
     try:
-        if cmd == "fetch_emails":
-            result = fetch_emails(*args)
-        elif cmd == "extract_expenses":
-            result = extract_expenses(*args)
-        elif cmd == "export_expenses":
-            result = export_expenses(*args)
-        elif cmd == "summary_today":
-            result = summary_today()
+        result = await asyncio.wait_for(coro, timeout)
+    except BaseException:
+        cancel_event.set()
+        metrics.observe_command(cmd, (time.perf_counter() - t0) * 1000, ok=False)
+        raise
+    metrics.observe_command(cmd, (time.perf_counter() - t0) * 1000, ok=True)
+    return results.put(result) if as_handle else result
+
+
+class AsyncMCPServer:
+    """Núcleo asyncio del servidor: lee stdin, despacha y responde por stdout.
+
+    Protocolo (una línea JSON por mensaje):
+      {"cmd": "...", "args": [...], "id": 1, "timeout": 5}
+      {"cmd": "cancel", "args": [1]}   -> cancela la petición con id 1
+      {"cmd": "fetch_emails", "args": [], "handle": true} -> {"result": {"$handle": "h_..", "n": 5}}
+      {"cmd": "negotiate", "args": [{"framing": "binary", "encoding": "msgpack"}]}
+    Las respuestas incluyen el mismo "id" cuando la petición lo trae. Tras
+    `negotiate` con framing binario, los mensajes siguientes usan mcp_framing.
+    """
+
+    def __init__(self, max_workers: int = MAX_WORKERS, max_pending: int = MAX_PENDING):
+        self.max_workers = max_workers
+        # Executor propio del tamaño de los workers: un handler cancelado que aún no llegó a
+        # su siguiente check_cancelled() sigue ocupando su hilo, así nunca corren más de max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mcp-handler")
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self.inflight: dict = {}
+        self.queued: set = set()        # ids en cola, aún sin worker
+        self.cancelled: set = set()     # ids cancelados mientras esperaban en cola
+        self.write_lock = asyncio.Lock()
+        self.encoding = None        # None = una línea JSON por mensaje
+
+    async def write(self, message: dict, req_id=None):
+        if req_id is not None:
+            message["id"] = req_id
+        if self.encoding is None:
+            chunks = [(json.dumps(message) + "\n").encode("utf-8")]
         else:
-            return json.dumps({"error": f"Unknown command: {cmd}"})
-        return json.dumps({"result": result})
-    except Exception as e:
-        return json.dumps({"error": str(e)})
+            chunks = mcp_framing.frames(mcp_framing.encode(message, self.encoding))
+        async with self.write_lock:
+            out = sys.stdout.buffer
+            for chunk in chunks:
+                out.write(chunk)
+            out.flush()
 
-if __name__ == "__main__":
-    while True:
-        try:
-            line = sys.stdin.readline()
+    def negotiate(self, options: Optional[dict]) -> dict:
+        options = options or {}
+        if options.get("framing") != "binary":
+            return {"framing": "line", "encoding": "json"}
+        encoding = mcp_framing.choose_encoding(options.get("encoding", "msgpack"))
+        return {"framing": "binary", "encoding": encoding}
+
+    async def read_message(self, reader):
+        """Devuelve (mensaje, error); mensaje None con error None = fin de stdin."""
+        if self.encoding is None:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                return None, "Mensaje demasiado grande"
             if not line:
-                break
-            data = json.loads(line.strip())
-            cmd = data.get("cmd")
-            args = data.get("args", [])
-            response = process_command(cmd, args)
-            sys.stdout.write(response + "\n")
-            sys.stdout.flush()
-        except json.JSONDecodeError:
-            sys.stdout.write(json.dumps({"error": "Invalid JSON"}) + "\n")
-            sys.stdout.flush()
+                return None, None
+            try:
+                return json.loads(line.strip()), None
+            except json.JSONDecodeError:
+                return None, "Invalid JSON"
+        try:
+            payload = await mcp_framing.read_message_async(reader)
+        except ValueError as e:
+            return None, str(e)
+        if not payload:
+            return None, None
+        try:
+            return mcp_framing.decode(payload, self.encoding), None
+        except Exception:
+            return None, "Mensaje binario inválido"
+
+    async def handle(self, data: dict):
+        req_id = data.get("id")
+        cmd = data.get("cmd")
+        args = data.get("args", [])
+        task = asyncio.current_task()
+        if req_id is not None:
+            self.inflight[req_id] = task
+        try:
+            result = await dispatch_command(cmd, args, data.get("timeout"), bool(data.get("handle")), self.executor)
+            await self.write({"result": result}, req_id)
+        except asyncio.CancelledError:
+            await self.write({"error": "Cancelled"}, req_id)
+        except asyncio.TimeoutError:
+            await self.write({"error": f"Timeout en {cmd}"}, req_id)
         except Exception as e:
-            sys.stdout.write(json.dumps({"error": str(e)}) + "\n")
-            sys.stdout.flush()
+            await self.write({"error": str(e)}, req_id)
+        finally:
+            if req_id is not None:
+                self.inflight.pop(req_id, None)
+
+    async def worker(self):
+        while True:
+            data = await self.queue.get()
+            try:
+                if data is None:
+                    return
+                req_id = data.get("id")
+                self.queued.discard(req_id)
+                if req_id in self.cancelled:
+                    self.cancelled.discard(req_id)
+                    await self.write({"error": "Cancelled"}, req_id)
+                    continue
+                await self.handle(data)
+            finally:
+                self.queue.task_done()
+
+    def cancel(self, req_id) -> bool:
+        """Cancela una petición en curso o todavía en cola."""
+        task = self.inflight.get(req_id)
+        if task is not None:
+            task.cancel()
+            return True
+        if req_id in self.queued:
+            self.cancelled.add(req_id)
+            return True
+        return False
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        if _stdin_is_pipe(sys.stdin):
+            reader = asyncio.StreamReader(limit=MAX_LINE_BYTES)
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        else:
+            reader = ThreadedStdinReader(sys.stdin.buffer)
+        workers = [asyncio.create_task(self.worker()) for _ in range(self.max_workers)]
+
+        while True:
+            data, error = await self.read_message(reader)
+            if error:
+                await self.write({"error": error})
+                if self.encoding is not None and error == "Mensaje demasiado grande":
+                    break       # stream binario desincronizado
+                continue
+            if data is None:
+                break
+            if not isinstance(data, dict):
+                await self.write({"error": "Invalid JSON"})
+                continue
+
+            if data.get("cmd") == "negotiate":
+                # Se responde en el modo actual y luego se cambia de framing
+                await self.queue.join()
+                chosen = self.negotiate((data.get("args") or [None])[0])
+                await self.write({"result": chosen}, data.get("id"))
+                self.encoding = chosen["encoding"] if chosen["framing"] == "binary" else None
+                continue
+
+            if data.get("cmd") == "cancel":
+                target = (data.get("args") or [None])[0]
+                await self.write({"result": self.cancel(target)}, data.get("id"))
+                continue
+
+            # Bloquea la lectura mientras la cola esté llena (backpressure)
+            if data.get("id") is not None:
+                self.queued.add(data["id"])
+            await self.queue.put(data)
+
+        await self.queue.join()
+        for _ in workers:
+            await self.queue.put(None)
+        await asyncio.gather(*workers)
+        self.executor.shutdown(wait=True)
+        if STATS_FILE:
+            metrics.dump(STATS_FILE)
+
+
+if __name__ == "__main__":
+    asyncio.run(AsyncMCPServer().serve())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Benchmark del planificador: ReAct vs prefetch vs motor de agenda.
+
+Sin API key estima tokens de entrada de cada camino (tiktoken si está
+instalado, si no ~4 caracteres por token) y mide la latencia del motor de
+agenda. Con --live ejecuta los tres modos contra OpenAI y mide tiempo y
+tokens reales.
+
+Uso: python3 bench_planner.py "Avanzar mi tesis y estudiar Azure Load Balancer" [--live]
+"""
+
+import argparse
+import json
+import statistics
+import time
+
+import daily_planner_agent as planner
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("o200k_base")
+except Exception:
+    _encoding = None
+
+
+def count_tokens(text: str) -> int:
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return max(1, len(text) // 4)
+
+
+def estimate_react(goal: str, compact: bool = False) -> dict:
+    """Reconstruye los prompts de un ReAct ideal: una herramienta por iteración + respuesta final."""
+    tools = "\n".join(f"{name}: {description}" for name, _, description in planner.TOOL_SPECS)
+    names = ", ".join(name for name, _, _ in planner.TOOL_SPECS)
+    base = planner.REACT_TEMPLATE.format(
+        tools=tools, tool_names=names, input=planner.react_task_prompt(goal), agent_scratchpad="{scratchpad}"
+    )
+    funcs = {name: func for name, func, _ in planner.TOOL_SPECS}
+    if compact:
+        funcs = {name: planner.truncated(func) for name, func in planner.COMPACT_TOOLS.items()}
+    steps = [
+        ("GetCalendarEvents", "", funcs["GetCalendarEvents"]()),
+        ("ListProjects", "", funcs["ListProjects"]()),
+        ("BreakDownGoal", goal, funcs["BreakDownGoal"](goal)),
+    ]
+    scratchpad, calls = "", []
+    for name, action_input, observation in steps:
+        calls.append(count_tokens(base.replace("{scratchpad}", scratchpad)))
+        scratchpad += f"Thought: necesito {name}\nAction: {name}\nAction Input: {action_input}\nObservation: {observation}\n"
+    calls.append(count_tokens(base.replace("{scratchpad}", scratchpad)))
+    return {"llm_calls": len(calls), "input_tokens": sum(calls)}
+
+
+def estimate_prefetch(goal: str) -> dict:
+    ctx = planner.prefetch_context(goal)
+    prompt = f"{goal}\n{ctx['calendar']}\n{ctx['projects']}\n{ctx['breakdown']}"
+    return {"llm_calls": 1, "input_tokens": count_tokens(prompt) + 40}
+
+
+def estimate_schedule(goal: str) -> dict:
+    timetable = planner.format_schedule(planner.build_schedule(goal))
+    return {"llm_calls": 1, "input_tokens": count_tokens(planner.schedule_prompt(goal, timetable))}
+
+
+def time_scheduler(goal: str, runs: int) -> dict:
+    events = json.loads(planner.get_calendar_events())["events"]
+    subtasks = json.loads(planner.break_down_goal(goal))["subtasks"]
+    samples = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        planner.schedule_day(events, subtasks)
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return {"p50_ms": round(statistics.median(samples), 4), "p99_ms": round(samples[int(0.99 * (len(samples) - 1))], 4)}
+
+
+def run_live(goal: str) -> dict:
+    from langchain.callbacks import get_openai_callback
+
+    results = {}
+    for mode in ("react", "prefetch", "schedule"):
+        with get_openai_callback() as cb:
+            t0 = time.perf_counter()
+            planner.plan_day(goal, mode)
+            elapsed = time.perf_counter() - t0
+        results[mode] = {
+            "seconds": round(elapsed, 2),
+            "llm_calls": cb.successful_requests,
+            "prompt_tokens": cb.prompt_tokens,
+            "completion_tokens": cb.completion_tokens,
+            "cost_usd": round(cb.total_cost, 6),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del planificador diario")
+    parser.add_argument("goal", nargs="?", default="Avanzar mi tesis y estudiar Azure Load Balancer")
+    parser.add_argument("--runs", type=int, default=1000)
+    parser.add_argument("--live", action="store_true", help="ejecuta los modos contra OpenAI")
+    args = parser.parse_args()
+
+    print("\n📈 BENCHMARK PLANIFICADOR")
+    print("=" * 60)
+    print(f"Objetivo: {args.goal}")
+    print(f"Tokens: {'tiktoken' if _encoding else 'estimación ~4 chars/token'}\n")
+    for mode, estimate in (("react", estimate_react), ("react-c", lambda g: estimate_react(g, True)),
+                           ("prefetch", estimate_prefetch), ("schedule", estimate_schedule)):
+        e = estimate(args.goal)
+        print(f"  {mode:<9} llamadas LLM={e['llm_calls']}  tokens de entrada≈{e['input_tokens']}")
+    sched = time_scheduler(args.goal, args.runs)
+    print(f"\nMotor de agenda: p50={sched['p50_ms']} ms  p99={sched['p99_ms']} ms ({args.runs} ejecuciones)")
+
+    if args.live:
+        print("\nEjecución real (OpenAI):")
+        for mode, r in run_live(args.goal).items():
+            print(f"  {mode:<9} {r['seconds']} s | llamadas={r['llm_calls']} | "
+                  f"tokens={r['prompt_tokens']}+{r['completion_tokens']} | ${r['cost_usd']}")
+    print("=" * 60)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,214 @@
 #!/usr/bin/env python3
 """Daily Planner Agent - ReAct Pattern con OpenAI"""
 
+import argparse
+import csv
+import functools
+import hashlib
 import json
+import math
+import random
+import re
+import sqlite3
 import sys
 import os
+import threading
+import time
+import unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from langchain.agents import AgentExecutor, create_react_agent
 from langchain.tools import Tool
 from langchain_openai import ChatOpenAI
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain_core.prompts import PromptTemplate
 
 
-def get_calendar_events(_input: str = None) -> str:
-    """Carga eventos del calendario desde archivo.
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PRIORITY_WEIGHT = {"high": 3, "medium": 2, "low": 1}
+DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+class JsonDataSource:
+    """Archivo JSON cargado una vez y recargado solo si cambia su mtime.
+
+    Guarda el JSON ya serializado para no re-serializarlo en cada llamada.
     """
-    with open("calendar_data.json") as f:
-        data = json.load(f)
-    return json.dumps(data, ensure_ascii=False)
+
+    def __init__(self, filename: str):
+        self.path = os.path.join(BASE_DIR, filename)
+        self.mtime = None
+        self.data = None
+        self.serialized = ""
+        self.lock = threading.Lock()
+
+    def _build(self):
+        """Índices derivados; se recalculan en cada recarga"""
+
+    def refresh(self):
+        mtime = os.path.getmtime(self.path)
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            with open(self.path, encoding="utf-8") as f:
+                self.data = json.load(f)
+            self.serialized = json.dumps(self.data, ensure_ascii=False)
+            self._build()
+            self.mtime = mtime
+
+
+class CalendarSource(JsonDataSource):
+    """Calendario indexado por fecha.
+
+    Los eventos con "date" (YYYY-MM-DD) solo aplican a ese día; los que no la
+    tienen se repiten todos los días (como en calendar_data.json). Los eventos
+    con "user" solo aplican a ese usuario; sin "user" aplican a todos.
+    """
+
+    def _build(self):
+        self.by_date = {}
+        self.every_day = []
+        for event in self.data.get("events", []):
+            if event.get("date"):
+                self.by_date.setdefault(event["date"], []).append(event)
+            else:
+                self.every_day.append(event)
+        self._day_cache = {}
+
+    def events_for(self, date: str, user: str = None) -> str:
+        self.refresh()
+        cached = self._day_cache.get((date, user))
+        if cached is None:
+            events = [e for e in self.every_day + self.by_date.get(date, []) if e.get("user") in (None, user)]
+            events.sort(key=lambda e: e.get("time", ""))
+            cached = json.dumps({"date": date, "events": events}, ensure_ascii=False)
+            self._day_cache[(date, user)] = cached
+        return cached
+
+
+calendar_source = CalendarSource("calendar_data.json")
+projects_source = JsonDataSource("projects_data.json")
+
+
+def get_calendar_events(_input: str = None, user: str = None) -> str:
+    """Eventos del calendario para una fecha (YYYY-MM-DD en el input, por defecto hoy).
+    """
+    match = DATE_RE.search(_input or "")
+    date = match.group() if match else datetime.now().strftime("%Y-%m-%d")
+    return calendar_source.events_for(date, user)
 
 
 def list_projects(_input: str = None) -> str:
     """Carga proyectos activos desde archivo.
     """
-    with open("projects_data.json") as f:
-        data = json.load(f)
-    return json.dumps(data, ensure_ascii=False)
+    projects_source.refresh()
+    return projects_source.serialized
 
 
-def break_down_goal(goal: str) -> str:
-    """Desglosa una meta en subtareas"""
-    subtasks = []
+def fold_text(text: str) -> str:
+    """Minúsculas y sin tildes ("Documentación" → "documentacion")."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(c for c in text if not unicodedata.combining(c))
 
-    if "tesis" in goal.lower():
-        subtasks.extend([
-            {"task": "Implementar backoff exponencial", "minutes": 90, "priority": "high"},
-            {"task": "Tests unitarios", "minutes": 60, "priority": "high"},
-            {"task": "Documentar", "minutes": 30, "priority": "medium"}
-        ])
 
-    if "azure" in goal.lower() or "load balancer" in goal.lower():
-        subtasks.extend([
-            {"task": "Estudiar Azure Load Balancer", "minutes": 60, "priority": "high"},
-            {"task": "Ejercicios prácticos", "minutes": 60, "priority": "high"}
-        ])
+class AhoCorasick:
+    """Autómata multi-patrón: encuentra todos los patrones en una sola pasada.
+
+    El costo de búsqueda depende del largo del texto y de las coincidencias,
+    no de la cantidad de patrones del catálogo.
+    """
+
+    def __init__(self, patterns: list):
+        self.patterns = patterns
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [[]]
+        for index, pattern in enumerate(patterns):
+            node = 0
+            for ch in pattern:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                node = nxt
+            self.out[node].append(index)
+        # Enlaces de fallo por BFS
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0) if node else 0
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+    def search(self, text: str):
+        """Produce (inicio, índice_de_patrón) por cada coincidencia."""
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(ch, 0)
+            for index in self.out[node]:
+                yield i - len(self.patterns[index]) + 1, index
+
+
+class GoalCatalog(JsonDataSource):
+    """Catálogo de plantillas de subtareas (goal_templates.json).
+
+    Cada plantilla tiene patrones (se comparan sin tildes y como palabras
+    completas) y subtareas con minutos y prioridad.
+    """
+
+    def _build(self):
+        self.templates = self.data.get("templates", [])
+        patterns, self.owner = [], []
+        for t_index, template in enumerate(self.templates):
+            for pattern in template.get("patterns", []):
+                patterns.append(fold_text(pattern))
+                self.owner.append(t_index)
+        self.matcher = AhoCorasick(patterns)
+
+    def match(self, goal: str) -> list:
+        """Plantillas que aplican al objetivo, en orden de aparición en el texto."""
+        self.refresh()
+        text = fold_text(goal)
+        found = {}
+        for start, p_index in self.matcher.search(text):
+            end = start + len(self.matcher.patterns[p_index])
+            if (start > 0 and text[start - 1].isalnum()) or (end < len(text) and text[end].isalnum()):
+                continue
+            t_index = self.owner[p_index]
+            found.setdefault(t_index, start)
+        return [self.templates[i] for i in sorted(found, key=found.get)]
+
+
+goal_catalog = GoalCatalog("goal_templates.json")
+
+
+def break_down_goal(goal: str) -> str:
+    """Desglosa una meta en subtareas"""
+    subtasks = {}
+    for template in goal_catalog.match(goal):
+        for task in template["subtasks"]:
+            key = fold_text(task["task"])
+            current = subtasks.get(key)
+            if current is None:
+                subtasks[key] = dict(task)
+            else:
+                # Misma subtarea en varias plantillas: una sola, con la mayor estimación y prioridad
+                current["minutes"] = max(current["minutes"], task["minutes"])
+                if PRIORITY_WEIGHT.get(task.get("priority"), 1) > PRIORITY_WEIGHT.get(current.get("priority"), 1):
+                    current["priority"] = task["priority"]
+    subtasks = list(subtasks.values())
 
     total_minutes = sum(t["minutes"] for t in subtasks) if subtasks else 0
 
@@ -54,27 +220,157 @@ def break_down_goal(goal: str) -> str:
     }, ensure_ascii=False)
 
 
-def create_agent():
-    """Crea el agente ReAct con OpenAI"""
-    tools = [
-        Tool(
-            name="GetCalendarEvents",
-            func=get_calendar_events,
-            description="Obtiene los eventos confirmados del calendario para el día (reuniones, bloques personales)"
-        ),
-        Tool(
-            name="ListProjects",
-            func=list_projects,
-            description="Lista los proyectos técnicos activos con su estado y prioridad"
-        ),
-        Tool(
-            name="BreakDownGoal",
-            func=break_down_goal,
-            description="Desglosa una meta en subtareas concretas con estimaciones de tiempo"
-        )
-    ]
+# --- Motor de agenda determinista -------------------------------------------
+
+DAY_START = "08:00"
+DAY_END = "19:00"
+LUNCH = ("13:00", "14:00")
+MAX_FOCUS = 90       # minutos seguidos de trabajo antes de una pausa
+BREAK_MINUTES = 15
+MIN_BLOCK = 25       # no se crean bloques de tarea más cortos que esto
+
+
+def to_minutes(hhmm: str) -> int:
+    h, m = hhmm.strip().split(":")
+    return int(h) * 60 + int(m)
+
+
+def to_hhmm(minutes: int) -> str:
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+def parse_interval(time_range: str) -> tuple:
+    start, end = time_range.split("-")
+    return to_minutes(start), to_minutes(end)
+
+
+def free_intervals(busy: list, day_start: int, day_end: int) -> list:
+    """Huecos libres del día dados intervalos ocupados (pueden solaparse)."""
+    free, cursor = [], day_start
+    for start, end in sorted(busy):
+        if start > cursor:
+            free.append((cursor, min(start, day_end)))
+        cursor = max(cursor, end)
+        if cursor >= day_end:
+            break
+    if cursor < day_end:
+        free.append((cursor, day_end))
+    return [(a, b) for a, b in free if b > a]
+
+
+def schedule_day(events: list, subtasks: list, day_start: str = DAY_START, day_end: str = DAY_END,
+                 lunch: tuple = LUNCH, max_focus: int = MAX_FOCUS, break_minutes: int = BREAK_MINUTES,
+                 min_block: int = MIN_BLOCK) -> dict:
+    """Empaqueta subtareas en los huecos libres entre eventos fijos.
+
+    Las tareas se ordenan por prioridad (y duración, de mayor a menor) y se
+    colocan en el primer hueco disponible; una tarea puede partirse entre
+    huecos en bloques de al menos `min_block` minutos. Tras `max_focus`
+    minutos de trabajo seguido se inserta una pausa de `break_minutes`.
+    Con partición permitida, este orden maximiza los minutos asignados
+    ponderados por prioridad. Devuelve bloques ordenados y lo no asignado.
+    """
+    start, end = to_minutes(day_start), to_minutes(day_end)
+    blocks = []
+    busy = []
+    for e in events:
+        a, b = parse_interval(e["time"])
+        busy.append((a, b))
+        blocks.append({"start": a, "end": b, "title": e.get("title", "Evento"), "kind": "event"})
+    if lunch:
+        a, b = to_minutes(lunch[0]), to_minutes(lunch[1])
+        if not any(x < b and a < y for x, y in busy):
+            busy.append((a, b))
+            blocks.append({"start": a, "end": b, "title": "Almuerzo", "kind": "lunch"})
+
+    pending = sorted(
+        ({"task": t["task"], "left": int(t["minutes"]), "priority": t.get("priority", "medium")} for t in subtasks),
+        key=lambda t: (-PRIORITY_WEIGHT.get(t["priority"], 1), -t["left"]),
+    )
+
+    for gap_start, gap_end in free_intervals(busy, start, end):
+        cursor, focus = gap_start, 0
+        for task in pending:
+            while task["left"] > 0:
+                need = min(min_block, task["left"])
+                if max_focus - focus < need:
+                    # Pausa obligatoria antes de seguir trabajando
+                    if gap_end - cursor < break_minutes + need:
+                        break
+                    blocks.append({"start": cursor, "end": cursor + break_minutes, "title": "Pausa", "kind": "break"})
+                    cursor += break_minutes
+                    focus = 0
+                room = min(gap_end - cursor, max_focus - focus)
+                chunk = min(task["left"], room)
+                rest = task["left"] - chunk
+                if 0 < rest < min_block:
+                    # No dejar un resto menor al bloque mínimo
+                    chunk = task["left"] - min_block
+                if chunk < need:
+                    break
+                blocks.append({"start": cursor, "end": cursor + chunk, "title": task["task"],
+                               "kind": "task", "priority": task["priority"]})
+                cursor += chunk
+                focus += chunk
+                task["left"] -= chunk
+            if cursor >= gap_end:
+                break
+
+    blocks.sort(key=lambda b: b["start"])
+    for b in blocks:
+        b["start"], b["end"] = to_hhmm(b["start"]), to_hhmm(b["end"])
+    unscheduled = [{"task": t["task"], "minutes": t["left"], "priority": t["priority"]} for t in pending if t["left"] > 0]
+    return {"blocks": blocks, "unscheduled": unscheduled}
+
+
+def format_schedule(schedule: dict) -> str:
+    lines = [f"- {b['start']} - {b['end']}: {b['title']}" for b in schedule["blocks"]]
+    if schedule["unscheduled"]:
+        lines.append("\nSin espacio hoy:")
+        lines += [f"- {t['task']} ({t['minutes']} min)" for t in schedule["unscheduled"]]
+    return "\n".join(lines)
+
+
+def build_schedule(user_goal: str, date: str = None, user: str = None) -> dict:
+    calendar = json.loads(get_calendar_events(date, user))
+    breakdown = json.loads(break_down_goal(user_goal))
+    return schedule_day(calendar["events"], breakdown["subtasks"])
+
+
+def create_llm():
+    """Cliente OpenAI para el agente ReAct y los modos prefetch/schedule"""
+    # OpenAI API - Volver a gpt-4o-mini que entiende mejor ReAct
+    return ChatOpenAI(
+        openai_api_key=os.getenv("OPENAI_API_KEY"),
+        model="gpt-4o-mini",
+        temperature=0.2,
+        max_tokens=1500
+    )
+
+
+_llm = None
+_llm_lock = threading.Lock()
+
+
+def get_llm():
+    """Cliente compartido: se crea una vez y lo reutilizan todos los planes"""
+    global _llm
+    with _llm_lock:
+        if _llm is None:
+            _llm = create_llm()
+        return _llm
 
-    template = """Responde usando este formato exacto:
+
+TOOL_SPECS = [
+    ("GetCalendarEvents", get_calendar_events,
+     "Obtiene los eventos confirmados del calendario para un día (reuniones, bloques personales). Input: fecha YYYY-MM-DD o vacío para hoy"),
+    ("ListProjects", list_projects,
+     "Lista los proyectos técnicos activos con su estado y prioridad"),
+    ("BreakDownGoal", break_down_goal,
+     "Desglosa una meta en subtareas concretas con estimaciones de tiempo"),
+]
+
+REACT_TEMPLATE = """Responde usando este formato exacto:
 Thought: [tu razonamiento]
 Action: [nombre de herramienta]
 Action Input: [parámetros]
@@ -92,15 +388,128 @@ Tarea: {input}
 
 {agent_scratchpad}"""
 
-    prompt = PromptTemplate.from_template(template)
 
-    # OpenAI API - Volver a gpt-4o-mini que entiende mejor ReAct
-    llm = ChatOpenAI(
-        openai_api_key=os.getenv("OPENAI_API_KEY"),
-        model="gpt-4o-mini",
-        temperature=0.2,
-        max_tokens=1500
-    )
+def react_task_prompt(user_goal: str, date: str = None) -> str:
+    day = f" (fecha {date}; úsala como input de GetCalendarEvents)" if date else ""
+    return f"""Genera un plan diario para: {user_goal}{day}
+
+Usa las herramientas:
+1. GetCalendarEvents - para eventos confirmados
+2. ListProjects - para proyectos activos
+3. BreakDownGoal - para desglosar el objetivo
+
+Retorna: Plan con horarios (8am-7pm), respetando calendario, balanceando trabajo y descansos."""
+
+
+# --- Observaciones compactas y presupuesto de tokens ------------------------
+
+TOKEN_BUDGET = int(os.getenv("PLANNER_TOKEN_BUDGET", "6000"))
+OBSERVATION_MAX_CHARS = 800
+
+
+def compact_calendar(_input: str = None, user: str = None) -> str:
+    """Solo hora, título y prioridad de cada evento"""
+    data = json.loads(get_calendar_events(_input, user))
+    lines = [f"- {e['time']} {e.get('title', '')} [{e.get('priority', '')}]" for e in data["events"]]
+    return f"Eventos {data['date']}:\n" + ("\n".join(lines) or "(ninguno)")
+
+
+def compact_projects(_input: str = None) -> str:
+    """Solo proyectos en curso con prioridad y avance"""
+    projects_source.refresh()
+    lines = [f"- {p['name']} [{p.get('priority', '')}, {p.get('progress', '')}]"
+             for p in projects_source.data.get("projects", []) if p.get("status") != "done"]
+    return "\n".join(lines) or "(sin proyectos activos)"
+
+
+def compact_breakdown(goal: str) -> str:
+    """Subtareas como lista corta con minutos y prioridad"""
+    data = json.loads(break_down_goal(goal))
+    lines = [f"- {t['task']}: {t['minutes']} min [{t['priority']}]" for t in data["subtasks"]]
+    return "\n".join(lines + [f"Total: {data['total_hours']} h"]) if lines else "(sin subtareas conocidas)"
+
+
+COMPACT_TOOLS = {
+    "GetCalendarEvents": compact_calendar,
+    "ListProjects": compact_projects,
+    "BreakDownGoal": compact_breakdown,
+}
+
+
+def truncated(func, max_chars: int = OBSERVATION_MAX_CHARS):
+    """Limita el largo de una observación para que el scratchpad no crezca sin control"""
+    def wrapper(*args, **kwargs):
+        text = func(*args, **kwargs)
+        return text if len(text) <= max_chars else text[:max_chars] + " …[recortado]"
+    return wrapper
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class TokenBudgetExceeded(RuntimeError):
+    pass
+
+
+class TokenBudget(BaseCallbackHandler):
+    """Cuenta tokens por iteración del agente y corta antes de pasarse del presupuesto.
+
+    Antes de cada llamada estima los tokens del prompt; si con ellos se supera
+    `limit`, lanza TokenBudgetExceeded y no se envía la petición.
+    """
+
+    raise_error = True
+
+    def __init__(self, limit: int = TOKEN_BUDGET):
+        self.limit = limit
+        self.iterations = []
+        self.used = 0
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        estimated = sum(estimate_tokens(p) for p in prompts)
+        if self.used + estimated > self.limit:
+            raise TokenBudgetExceeded(
+                f"Presupuesto de {self.limit} tokens agotado ({self.used} usados, siguiente prompt ≈{estimated})")
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        prompts = ["".join(str(m.content) for m in batch) for batch in messages]
+        self.on_llm_start(serialized, prompts, **kwargs)
+
+    def on_llm_end(self, response, **kwargs):
+        usage = (response.llm_output or {}).get("token_usage", {})
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+        self.iterations.append({"prompt": prompt_tokens, "completion": completion_tokens})
+        self.used += prompt_tokens + completion_tokens
+
+    def summary(self) -> str:
+        lines = [f"  iteración {i}: {it['prompt']} + {it['completion']} tokens"
+                 for i, it in enumerate(self.iterations, 1)]
+        lines.append(f"  total: {self.used} / {self.limit}")
+        return "\n".join(lines)
+
+
+def create_agent(compact: bool = True, user: str = None):
+    """Crea el agente ReAct con OpenAI.
+
+    Con compact=True las herramientas devuelven solo los campos que usa el
+    planificador, recortados a OBSERVATION_MAX_CHARS. `user` se fija en la
+    herramienta de calendario para incluir los eventos de ese usuario.
+    """
+    tools = []
+    for name, func, description in TOOL_SPECS:
+        func = COMPACT_TOOLS[name] if compact else func
+        if name == "GetCalendarEvents":
+            func = functools.partial(func, user=user)
+        if compact:
+            func = truncated(func)
+        tools.append(Tool(name=name, func=func, description=description))
+
+    template = REACT_TEMPLATE
+
+    prompt = PromptTemplate.from_template(template)
+    llm = get_llm()
 
     agent = create_react_agent(llm=llm, tools=tools, prompt=prompt)
 
@@ -113,35 +522,410 @@ Tarea: {input}
     )
 
 
-def plan_day(user_goal: str) -> str:
-    """Genera plan diario usando el agente ReAct con OpenAI"""
-    executor = create_agent()
+def prefetch_context(user_goal: str, date: str = None, user: str = None) -> dict:
+    """Ejecuta las tres herramientas en paralelo (son independientes entre sí)"""
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        calendar = pool.submit(get_calendar_events, date, user)
+        projects = pool.submit(list_projects)
+        breakdown = pool.submit(break_down_goal, user_goal)
+        return {
+            "calendar": calendar.result(),
+            "projects": projects.result(),
+            "breakdown": breakdown.result(),
+        }
+
+
+def plan_day_prefetched(user_goal: str, date: str = None, user: str = None) -> str:
+    """Genera el plan con una sola llamada al LLM.
+
+    El contexto (calendario, proyectos, desglose) se obtiene en paralelo antes
+    de llamar al modelo, así no se paga un round-trip ReAct por herramienta.
+    """
+    context = prefetch_context(user_goal, date, user)
 
     prompt = f"""Genera un plan diario para: {user_goal}
 
-Usa las herramientas:
-1. GetCalendarEvents - para eventos confirmados
-2. ListProjects - para proyectos activos
-3. BreakDownGoal - para desglosar el objetivo
+Eventos confirmados del calendario:
+{context["calendar"]}
+
+Proyectos activos:
+{context["projects"]}
+
+Desglose del objetivo:
+{context["breakdown"]}
 
 Retorna: Plan con horarios (8am-7pm), respetando calendario, balanceando trabajo y descansos."""
 
-    # Mostrar prompt final
-    print("\n" + "="*70)
-    print("📤 PROMPT ENVIADO A LANGCHAIN:")
-    print("="*70 + "\n")
-    print(prompt)
-    print("\n" + "="*70 + "\n")
+    return get_llm().invoke(prompt).content
+
+
+def schedule_prompt(user_goal: str, timetable: str) -> str:
+    return f"""Objetivo del día: {user_goal}
+
+Horario ya calculado (no cambies horas ni tareas):
+{timetable}
+
+Redacta el plan diario de forma clara y breve, con una recomendación final."""
+
+
+def plan_day_scheduled(user_goal: str, phrase: bool = True, date: str = None, user: str = None) -> str:
+    """Plan con el motor de agenda; el LLM solo redacta el horario ya calculado."""
+    timetable = format_schedule(build_schedule(user_goal, date, user))
+    if not phrase:
+        return timetable
+    return get_llm().invoke(schedule_prompt(user_goal, timetable)).content
+
+
+def generate_plan(user_goal: str, mode: str, date: str = None, user: str = None,
+                  budget: TokenBudget = None) -> str:
+    """Genera el plan en el modo pedido; las excepciones se propagan.
+
+    En modo ReAct, si se agota el presupuesto de tokens se devuelve el horario
+    del motor de agenda en lugar de seguir iterando.
+    """
+    if mode == "prefetch":
+        return plan_day_prefetched(user_goal, date, user)
+    if mode in ("schedule", "offline"):
+        return plan_day_scheduled(user_goal, mode == "schedule", date, user)
+    budget = budget or TokenBudget()
+    compact = os.getenv("PLANNER_COMPACT", "1") != "0"
+    try:
+        response = create_agent(compact, user).invoke(
+            {"input": react_task_prompt(user_goal, date)}, config={"callbacks": [budget]}
+        )
+    except TokenBudgetExceeded as e:
+        return f"{plan_day_scheduled(user_goal, False, date, user)}\n\n(⚠️ {e}; horario generado sin LLM)"
+    return response.get("output", "Error generando plan")
+
+
+def plan_day(user_goal: str, mode: str = None, date: str = None, user: str = None) -> str:
+    """Genera plan diario usando el agente ReAct con OpenAI.
 
+    mode="prefetch" (o PLANNER_MODE=prefetch) obtiene el contexto en paralelo
+    y hace una única llamada al LLM en lugar del bucle ReAct.
+    mode="schedule" calcula el horario con schedule_day y usa el LLM solo para
+    redactarlo; mode="offline" devuelve el horario sin llamar al LLM.
+    """
+    mode = mode or os.getenv("PLANNER_MODE", "react")
+
+    if mode == "react":
+        # Mostrar prompt final
+        print("\n" + "="*70)
+        print("📤 PROMPT ENVIADO A LANGCHAIN:")
+        print("="*70 + "\n")
+        print(react_task_prompt(user_goal, date))
+        print("\n" + "="*70 + "\n")
+
+    budget = TokenBudget()
     try:
-        response = executor.invoke({"input": prompt})
-        return response.get("output", "Error generando plan")
+        plan = generate_plan(user_goal, mode, date, user, budget)
+        if mode == "react":
+            print("🔢 Tokens por iteración:\n" + budget.summary() + "\n")
+        return plan
     except Exception as e:
+        if mode == "schedule":
+            timetable = format_schedule(build_schedule(user_goal, date, user))
+            return f"{timetable}\n\n(⚠️ Sin redacción del LLM: {str(e)})"
         return f"❌ Error: {str(e)}\n\n💡 Verifica:\n- OPENAI_API_KEY está configurada\n- Tienes créditos en OpenAI\n- La API key es válida"
 
 
+# --- Planificación por lotes -------------------------------------------------
+
+BATCH_CONCURRENCY = int(os.getenv("PLANNER_CONCURRENCY", "4"))
+MAX_RETRIES = 5
+
+
+def is_rate_limit(error: Exception) -> bool:
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status == 429 or type(error).__name__ == "RateLimitError" or "rate limit" in str(error).lower()
+
+
+def retry_after(error: Exception) -> float:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def generate_with_retry(user_goal: str, mode: str, date: str = None, user: str = None) -> tuple:
+    """Reintenta con backoff exponencial (y Retry-After si viene) ante límites de tasa."""
+    for attempt in range(1, MAX_RETRIES + 1):
+        try:
+            return generate_plan(user_goal, mode, date, user), attempt
+        except Exception as e:
+            if not is_rate_limit(e) or attempt == MAX_RETRIES:
+                raise
+            delay = max(retry_after(e), min(60, 2 ** attempt)) + random.uniform(0, 1)
+            time.sleep(delay)
+
+
+def load_batch(path: str) -> list:
+    """Registros (user, date, goal) desde JSONL o CSV."""
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    for row in rows:
+        if not row.get("goal"):
+            raise ValueError(f"Registro sin 'goal': {row}")
+    return rows
+
+
+class BatchStore:
+    """Salida única e indexada de un lote: tabla SQLite con índice por (user, date)."""
+
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.conn:
+            self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS planes (
+                user TEXT NOT NULL,
+                date TEXT NOT NULL,
+                goal TEXT NOT NULL,
+                mode TEXT NOT NULL,
+                plan TEXT,
+                error TEXT,
+                attempts INTEGER,
+                seconds REAL,
+                created TEXT,
+                PRIMARY KEY (user, date, goal)
+            );
+            CREATE INDEX IF NOT EXISTS idx_planes_date ON planes(date);
+            """)
+
+    def save(self, row: dict):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO planes (user, date, goal, mode, plan, error, attempts, seconds, created) "
+                "VALUES (:user, :date, :goal, :mode, :plan, :error, :attempts, :seconds, :created)",
+                row,
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+def run_batch(records: list, out_path: str, mode: str = None, concurrency: int = BATCH_CONCURRENCY) -> dict:
+    """Genera planes para muchos (user, date, goal) con concurrencia acotada.
+
+    Comparte el cliente LLM y los datos ya cargados; cada resultado se guarda
+    en `out_path` apenas termina.
+    """
+    mode = mode or os.getenv("PLANNER_MODE", "prefetch")
+    store = BatchStore(out_path)
+    today = datetime.now().strftime("%Y-%m-%d")
+
+    def work(record):
+        row = {"user": record.get("user") or "", "date": record.get("date") or today,
+               "goal": record["goal"], "mode": mode, "plan": None, "error": None, "attempts": 0}
+        t0 = time.perf_counter()
+        try:
+            row["plan"], row["attempts"] = generate_with_retry(row["goal"], mode, row["date"], row["user"] or None)
+        except Exception as e:
+            row["error"] = str(e)
+        row["seconds"] = round(time.perf_counter() - t0, 3)
+        row["created"] = datetime.now().isoformat(timespec="seconds")
+        store.save(row)
+        return row
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        rows = list(pool.map(work, records))
+    store.close()
+    failed = sum(1 for r in rows if r["error"])
+    return {"planes": len(rows), "errores": failed, "segundos": round(time.perf_counter() - t0, 2), "salida": out_path}
+
+
+# --- Caché de planes ---------------------------------------------------------
+
+PLAN_INDEX = os.path.join(BASE_DIR, "plans_index.json")
+SIMILARITY_THRESHOLD = float(os.getenv("PLAN_CACHE_THRESHOLD", "0.9"))
+
+
+def normalize_goal(goal: str) -> str:
+    """Minúsculas, sin tildes ni puntuación y con espacios colapsados."""
+    return " ".join(re.sub(r"[^\w\s]", " ", fold_text(goal)).split())
+
+
+def data_fingerprint() -> str:
+    """Hash del calendario, proyectos y catálogo: si cambian, los planes guardados no sirven."""
+    calendar_source.refresh()
+    projects_source.refresh()
+    goal_catalog.refresh()
+    raw = "\n".join([calendar_source.serialized, projects_source.serialized, goal_catalog.serialized])
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def trigram_embedding(text: str) -> dict:
+    """Vector disperso de trigramas de caracteres (sin dependencias ni API)."""
+    padded = f"  {text} "
+    vec = {}
+    for i in range(len(padded) - 2):
+        tri = padded[i:i + 3]
+        vec[tri] = vec.get(tri, 0) + 1
+    norm = math.sqrt(sum(v * v for v in vec.values())) or 1.0
+    return {k: v / norm for k, v in vec.items()}
+
+
+def openai_embedding(text: str) -> list:
+    from langchain_openai import OpenAIEmbeddings
+    return OpenAIEmbeddings(openai_api_key=os.getenv("OPENAI_API_KEY")).embed_query(text)
+
+
+def cosine(a, b) -> float:
+    if isinstance(a, dict):
+        if len(a) > len(b):
+            a, b = b, a
+        return sum(v * b.get(k, 0.0) for k, v in a.items())
+    dot = sum(x * y for x, y in zip(a, b))
+    na, nb = math.sqrt(sum(x * x for x in a)), math.sqrt(sum(y * y for y in b))
+    return dot / (na * nb) if na and nb else 0.0
+
+
+class PlanCache:
+    """Índice de planes generados hoy, reutilizables para objetivos iguales o parecidos.
+
+    Clave exacta: objetivo normalizado + modo + hash de calendario/proyectos.
+    Si no hay coincidencia exacta solo sirven entradas con las mismas plantillas
+    de goal_catalog (así "estudiar Azure" no reutiliza "estudiar NATS"); entre
+    ellas elige la más parecida por embedding (trigramas por defecto, OpenAI
+    con PLAN_CACHE_EMBEDDINGS=openai).
+    Las entradas de días anteriores se descartan al cargar el índice.
+    """
+
+    def __init__(self, path: str = PLAN_INDEX, embedder: str = None):
+        self.path = path
+        self.embedder = embedder or os.getenv("PLAN_CACHE_EMBEDDINGS", "trigram")
+        self.lock = threading.Lock()
+        self.entries = self._load()
+
+    def _load(self) -> list:
+        today = datetime.now().strftime("%Y-%m-%d")
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return []
+        return [e for e in entries if e.get("date") == today and os.path.exists(e.get("file", ""))]
+
+    def _save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def _embed(self, normalized: str):
+        if self.embedder == "openai":
+            return openai_embedding(normalized)
+        return trigram_embedding(normalized)
+
+    def _key(self, normalized: str, mode: str, fingerprint: str) -> str:
+        return hashlib.sha1(f"{normalized}|{mode}|{fingerprint}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _templates(goal: str) -> list:
+        return [t.get("id") for t in goal_catalog.match(goal)]
+
+    def lookup(self, goal: str, mode: str) -> dict:
+        """Devuelve {"plan", "file", "goal", "similarity"} o None."""
+        today = datetime.now().strftime("%Y-%m-%d")
+        normalized = normalize_goal(goal)
+        fingerprint = data_fingerprint()
+        key = self._key(normalized, mode, fingerprint)
+        with self.lock:
+            candidates = [e for e in self.entries
+                          if e["date"] == today and e["mode"] == mode and e["data"] == fingerprint]
+        best, score = None, 0.0
+        for e in candidates:
+            if e["key"] == key:
+                best, score = e, 1.0
+                break
+        if best is None and candidates:
+            # Sin plantillas el plan depende solo del texto: únicamente coincidencia exacta
+            templates = self._templates(goal)
+            candidates = [e for e in candidates if templates and e.get("templates") == templates
+                          and e.get("embedder") == self.embedder]
+            vector = self._embed(normalized) if candidates else None
+            for e in candidates:
+                sim = cosine(vector, e["embedding"])
+                if sim > score:
+                    best, score = e, sim
+            if score < SIMILARITY_THRESHOLD:
+                return None
+        if best is None:
+            return None
+        try:
+            with open(best["file"], encoding="utf-8") as f:
+                plan = f.read()
+        except OSError:
+            return None
+        return {"plan": plan, "file": best["file"], "goal": best["goal"], "similarity": round(score, 3)}
+
+    def store(self, goal: str, mode: str, filename: str):
+        normalized = normalize_goal(goal)
+        fingerprint = data_fingerprint()
+        entry = {
+            "key": self._key(normalized, mode, fingerprint),
+            "goal": goal,
+            "normalized": normalized,
+            "mode": mode,
+            "data": fingerprint,
+            "date": datetime.now().strftime("%Y-%m-%d"),
+            "file": os.path.abspath(filename),
+            "templates": self._templates(goal),
+            "embedder": self.embedder,
+            "embedding": self._embed(normalized),
+        }
+        with self.lock:
+            self.entries = [e for e in self.entries if e["key"] != entry["key"]] + [entry]
+            self._save()
+
+
+def save_plan_file(user_goal: str, plan: str) -> str:
+    """Guarda el plan en plan_YYYYMMDD_HHMMSS.txt y devuelve el nombre"""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"plan_{timestamp}.txt"
+    n = 1
+    while os.path.exists(filename):
+        # Varios planes en el mismo segundo: no pisar uno ya indexado
+        n += 1
+        filename = f"plan_{timestamp}_{n}.txt"
+
+    with open(filename, "x", encoding="utf-8") as f:
+        f.write("="*70 + "\n")
+        f.write("PLAN DIARIO GENERADO\n")
+        f.write("="*70 + "\n\n")
+        f.write(f"Fecha: {datetime.now().strftime('%A, %d de %B de %Y')}\n")
+        f.write(f"Objetivo: {user_goal}\n\n")
+        f.write("="*70 + "\n\n")
+        f.write(plan)
+        f.write("\n\n" + "="*70 + "\n")
+    return filename
+
+
+def main_batch(argv: list):
+    """Modo lote: python3 daily_planner_agent.py --batch registros.jsonl"""
+    parser = argparse.ArgumentParser(description="Planificación por lotes")
+    parser.add_argument("--batch", required=True, help="JSONL o CSV con user, date, goal")
+    parser.add_argument("--out", default="plans_batch.db", help="SQLite de salida")
+    parser.add_argument("--mode", default=None, help="react | prefetch | schedule | offline")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY)
+    args = parser.parse_args(argv)
+
+    records = load_batch(args.batch)
+    print(f"\n⏳ Generando {len(records)} planes (concurrencia {args.concurrency})...\n")
+    summary = run_batch(records, args.out, args.mode, args.concurrency)
+    print(f"✅ {summary['planes']} planes ({summary['errores']} con error) en {summary['segundos']} s → {summary['salida']}")
+
+
 def main():
     """Entrada principal"""
+    if len(sys.argv) > 1:
+        return main_batch(sys.argv[1:])
+
     print("\n" + "="*70)
     print("🤖 DAILY PLANNER AGENT - ReAct con OpenAI")
     print("="*70 + "\n")
@@ -160,24 +944,23 @@ def main():
         print("❌ Error: Debes ingresar un objetivo")
         sys.exit(1)
 
+    mode = os.getenv("PLANNER_MODE", "react")
+    cache = PlanCache()
+    cached = cache.lookup(user_goal, mode)
+    if cached:
+        print(f"♻️  Plan reutilizado ({cached['file']}, similitud {cached['similarity']}, objetivo: {cached['goal']})\n")
+        print(f"Contenido:\n\n{cached['plan']}\n")
+        return
+
     print("\n⏳ Generando plan con OpenAI...\n")
 
     # Generar plan
-    plan = plan_day(user_goal)
+    plan = plan_day(user_goal, mode)
 
     # Guardar en archivo
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"plan_{timestamp}.txt"
-
-    with open(filename, "w", encoding="utf-8") as f:
-        f.write("="*70 + "\n")
-        f.write("PLAN DIARIO GENERADO\n")
-        f.write("="*70 + "\n\n")
-        f.write(f"Fecha: {datetime.now().strftime('%A, %d de %B de %Y')}\n")
-        f.write(f"Objetivo: {user_goal}\n\n")
-        f.write("="*70 + "\n\n")
-        f.write(plan)
-        f.write("\n\n" + "="*70 + "\n")
+    filename = save_plan_file(user_goal, plan)
+    if not plan.startswith("❌"):
+        cache.store(user_goal, mode, filename)
 
     print(f"✅ Plan guardado en: {filename}\n")
     print(f"Contenido:\n\n{plan}\n")